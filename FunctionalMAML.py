@@ -0,0 +1,347 @@
+import contextlib
+import warnings
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.func import functional_call, grad, vmap
+
+from utilities import upcast
+
+
+# The double backward of the native layer and batch norms is wrong under vmap (torch
+# 2.4), so the second-order adaptation of all tasks at once uses these plain versions.
+# As the native kernels, they normalize half precision inputs in fp32 under autocast.
+
+
+def _layer_norm(input, normalized_shape, weight=None, bias=None, eps=1e-5):
+    dims = tuple(range(-len(normalized_shape), 0))
+    x = upcast(input)
+    mean = x.mean(dims, keepdim=True)
+    var = x.var(dims, unbiased=False, keepdim=True)
+    output = ((x - mean) * torch.rsqrt(var + eps)).to(input.dtype)
+    if weight is not None:
+        output = output * weight
+    if bias is not None:
+        output = output + bias
+    return output
+
+
+def _batch_norm(
+    input,
+    running_mean,
+    running_var,
+    weight=None,
+    bias=None,
+    training=False,
+    momentum=0.1,
+    eps=1e-5,
+):
+    dims = [0, *range(2, input.dim())]
+    shape = [1, -1] + [1] * (input.dim() - 2)
+    x = upcast(input)
+    if training:
+        mean = x.mean(dims)
+        var = x.var(dims, unbiased=False)
+        if running_mean is not None:
+            n = input.numel() / input.size(1)
+            with torch.no_grad():
+                running_mean.mul_(1 - momentum).add_(momentum * mean.detach())
+                running_var.mul_(1 - momentum).add_(
+                    momentum * n / (n - 1) * var.detach()
+                )
+    else:
+        mean, var = running_mean, running_var
+    output = (x - mean.view(shape)) * torch.rsqrt(var.view(shape) + eps)
+    output = output.to(input.dtype)
+    if weight is not None:
+        output = output * weight.view(shape)
+    if bias is not None:
+        output = output + bias.view(shape)
+    return output
+
+
+def _forward(net, params, buffers, x, kwargs):
+    # functional forward of the network, the function compiled with --compile
+    return functional_call(net, (params, buffers), (x,), kwargs)
+
+
+# the inductor backward of linear upsampling is wrong (torch 2.4), so F.interpolate runs
+# in eager mode between the compiled graphs
+_eager_interpolate = torch._dynamo.disable(F.interpolate)
+
+
+def _compile_settings():
+    """
+    Settings of the compiled forward, patched around its calls only, so that they do not
+    stay set for the rest of the process (e.g. the next trials of a sweep worker). The
+    parameters given to functional_call are inputs of the graph rather than constants, so
+    a graph is reused with the fast weights of every task.
+    """
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch._dynamo.config.patch(inline_inbuilt_nn_modules=True))
+    stack.enter_context(mock.patch.object(F, "interpolate", _eager_interpolate))
+    return stack
+
+
+class FlatParameters:
+    """
+    Layout of the (adapted) parameters of a network in one flat vector, so that fast
+    weights are a single tensor and an inner-loop step is a single fused update.
+    """
+
+    def __init__(self, named_parameters):
+        named = list(named_parameters)
+        self.names = [k for k, _ in named]
+        self.shapes = [p.shape for _, p in named]
+        self.numels = [p.numel() for _, p in named]
+        self.numel = sum(self.numels)
+
+    def flatten(self, params, out=None):
+        """Concatenates a dictionary of parameters, into out if given."""
+        flat = [params[k].reshape(-1) for k in self.names]
+        if out is None:
+            return torch.cat(flat)
+        return torch.cat(flat, out=out)
+
+    def unflatten(self, flat):
+        """Dictionary of views of the flat vector, shaped as the parameters."""
+        return {
+            k: t.view(shape)
+            for k, t, shape in zip(self.names, flat.split(self.numels), self.shapes)
+        }
+
+
+class InnerSGD(nn.Module):
+    """
+    SGD on flat fast weights, with one learning rate per parameter tensor. The learning
+    rates are meta-learned (as in Meta-SGD, per tensor) when learn_lr is set, otherwise
+    they all stay at lr.
+    """
+
+    def __init__(self, layout, lr, learn_lr=False):
+        super().__init__()
+        lrs = torch.full((len(layout.numels),), float(lr))
+        if learn_lr:
+            self.lr = nn.Parameter(lrs)
+        else:
+            self.register_buffer("lr", lrs)
+        self.register_buffer("numels", torch.tensor(layout.numels), persistent=False)
+
+    def flat_lr(self):
+        """Learning rate of every entry of the flat fast weights."""
+        return self.lr.repeat_interleave(self.numels, output_size=int(self.numels.sum()))
+
+    def step(self, flat, grads, flat_lr):
+        return flat - flat_lr * grads
+
+    @torch.no_grad()
+    def step_(self, flat, grads, flat_lr):
+        """In-place step, for adaptation that is not differentiated through."""
+        return flat.addcmul_(flat_lr, grads, value=-1)
+
+
+class FunctionalMAML:
+    """
+    MAML on torch.func: the fast weights of all tasks of a batch are adapted in parallel,
+    with vmap over the tasks, and the summed query loss is backpropagated once.
+
+    The fast weights are kept flat (see FlatParameters) and updated by InnerSGD. The
+    adaptation is differentiated through (second order) unless first_order is set, in
+    which case the inner gradients are detached as with --fomaml. As with
+    higher.innerloop_ctx, every task runs on its own copy of the buffers of the network
+    (e.g. the BatchNorm running statistics), and the buffers of the network stay as they
+    are.
+
+    The inner loop adapts the parameters that require grad, of the stages of the model
+    from adapt_scope on (all of them by default). The leading stages without adapted
+    parameters (the frozen prefix, or body) give the same activations at every inner
+    step: they are run once per task on the support and query sets, and the inner loop
+    only runs the remaining stages.
+
+    With compile, the forward of the network is compiled by torch.compile, once per
+    stage slice and input shape, and reused across tasks and epochs. Dynamo does not
+    trace through vmap and compiled graphs have no double backward, so the compiled
+    forward serves the evaluation and a first-order adaptation of the tasks one after
+    the other, while the second-order adaptation stays vmapped in eager mode.
+    """
+
+    def __init__(
+        self,
+        net,
+        inner_lr,
+        n_inner_iter,
+        first_order=False,
+        learn_lr=False,
+        adapt_scope="all",
+        loss_scale=1.0,
+        compile=False,
+    ):
+        self.net = net
+        # static scale of the support loss, against fp16 underflow of the inner gradients
+        self.loss_scale = loss_scale
+        self.n_inner_iter = n_inner_iter
+        self.first_order = first_order
+        params = dict(net.named_parameters())
+        adapted = list(params)
+        if adapt_scope != "all":
+            adapted = net.stage_parameter_names(net.STAGES.index(adapt_scope))
+        adapted = [k for k in adapted if params[k].requires_grad]
+        if not adapted:
+            raise ValueError("No parameter is adapted in the inner loop")
+        self.split = net.frozen_stages(adapted)
+        self.layout = FlatParameters((k, params[k]) for k in adapted)
+        param = next(net.parameters())
+        self.inner_opt = InnerSGD(self.layout, inner_lr, learn_lr).to(param.device, param.dtype)
+        # fast weights of the task being evaluated, reused across tasks and epochs
+        self._fast = None
+        self._compiled = None
+        if compile:
+            self._compiled = torch.compile(_forward, dynamic=False)
+        self._vmapped = False
+
+    def parameters(self):
+        """Meta-learned parameters of the inner loop, to add to the meta optimizer."""
+        return self.inner_opt.parameters()
+
+    def _call(self, params, buffers, x, kwargs):
+        if self._compiled is None or self._vmapped:
+            return _forward(self.net, params, buffers, x, kwargs)
+        try:
+            with _compile_settings():
+                return self._compiled(self.net, params, buffers, x, kwargs)
+        except Exception as e:
+            # an error of the model itself is raised again by the eager forward
+            warnings.warn(f"torch.compile failed, falling back to eager mode: {e}")
+            self._compiled = None
+            return _forward(self.net, params, buffers, x, kwargs)
+
+    def _body(self, params, buffers, x):
+        """Features of the stages that are not adapted, the input of _head."""
+        if self.split == 0:
+            return x
+        return self._call(params, buffers, x, {"stages": slice(None, self.split)})
+
+    def _head(self, params, buffers, h):
+        if self.split == 0:
+            return self._call(params, buffers, h, {})
+        return self._call(params, buffers, h, {"stages": slice(self.split, None)})
+
+    def _loss(self, flat, params, buffers, h, y):
+        logits = self._head({**params, **self.layout.unflatten(flat)}, buffers, h)
+        return F.cross_entropy(upcast(logits), y.long()) * self.loss_scale
+
+    def adapt(self, flat, flat_lr, params, buffers, h_spt, y_spt):
+        """
+        Fast weights of one task after n_inner_iter SGD steps on the body features of its
+        support set.
+        """
+        for _ in range(self.n_inner_iter):
+            grads = grad(self._loss)(flat, params, buffers, h_spt, y_spt)
+            grads = grads / self.loss_scale
+            if self.first_order:
+                grads = grads.detach()
+            flat = self.inner_opt.step(flat, grads, flat_lr)
+        return flat
+
+    def _task_logits(self, flat, flat_lr, params, buffers, x_spt, y_spt, x_qry):
+        # to first order, the support features only feed detached inner gradients
+        with torch.no_grad() if self.first_order else contextlib.nullcontext():
+            h_spt = self._body(params, buffers, x_spt)
+        h_qry = self._body(params, buffers, x_qry)
+        fast = self.adapt(flat, flat_lr, params, buffers, h_spt, y_spt)
+        return self._head({**params, **self.layout.unflatten(fast)}, buffers, h_qry)
+
+    def _sequential_logits(self, flat, flat_lr, params, buffers, x_spt, y_spt, x_qry):
+        # first-order _task_logits with torch.autograd.grad, on the compiled forward
+        logits = []
+        for i in range(x_spt.size(0)):
+            task_buffers = {k: b[i] for k, b in buffers.items()}
+            with torch.no_grad():
+                h_spt = self._body(params, task_buffers, x_spt[i])
+            h_qry = self._body(params, task_buffers, x_qry[i])
+            fast = flat
+            for _ in range(self.n_inner_iter):
+                inner = fast.detach().requires_grad_(True)
+                loss = self._loss(inner, params, task_buffers, h_spt, y_spt[i])
+                (grads,) = torch.autograd.grad(loss, inner)
+                fast = self.inner_opt.step(fast, grads / self.loss_scale, flat_lr)
+            fast_params = self.layout.unflatten(fast)
+            logits.append(self._head({**params, **fast_params}, task_buffers, h_qry))
+        return torch.stack(logits)
+
+    def query_logits(self, x_spt, y_spt, x_qry):
+        """
+        Adapts to every task of the batch (task_num, setsz, ...) and returns the logits of
+        their query sets, differentiable with respect to the parameters of the network.
+        """
+        task_num = x_spt.size(0)
+        params = dict(self.net.named_parameters())
+        flat = self.layout.flatten(params)
+        # every task updates its own copy of the buffers (e.g. BatchNorm running stats),
+        # discarded after the task as by higher.innerloop_ctx
+        buffers = {
+            k: b.unsqueeze(0).expand(task_num, *b.shape).clone()
+            for k, b in self.net.named_buffers()
+        }
+        if self._compiled is not None and self.first_order:
+            logits = self._sequential_logits(
+                flat, self.inner_opt.flat_lr(), params, buffers, x_spt, y_spt, x_qry
+            )
+        else:
+            norms = contextlib.nullcontext()
+            if not self.first_order:
+                norms = mock.patch.multiple(
+                    F, layer_norm=_layer_norm, batch_norm=_batch_norm
+                )
+            self._vmapped = True
+            try:
+                with norms:
+                    logits = vmap(
+                        self._task_logits,
+                        in_dims=(None, None, None, 0, 0, 0, 0),
+                        randomness="different",
+                    )(flat, self.inner_opt.flat_lr(), params, buffers, x_spt, y_spt, x_qry)
+            finally:
+                self._vmapped = False
+        return logits
+
+    def fast_weights(self, params, buffers, h_spt, y_spt):
+        """
+        Adapts to one task without differentiating through the adaptation, for evaluation.
+        The fast weights are updated in place in a flat buffer allocated once, and returned
+        as a dictionary of views to use with functional_call.
+        """
+        param = next(iter(params.values()))
+        if self._fast is None or self._fast.device != param.device:
+            self._fast = torch.empty(
+                self.layout.numel, dtype=param.dtype, device=param.device
+            )
+        fast = self._fast
+        with torch.no_grad():
+            self.layout.flatten(params, out=fast)
+            flat_lr = self.inner_opt.flat_lr()
+        fast.requires_grad_(True)
+        for _ in range(self.n_inner_iter):
+            loss = self._loss(fast, params, buffers, h_spt, y_spt)
+            (grads,) = torch.autograd.grad(loss, fast)
+            self.inner_opt.step_(fast, grads / self.loss_scale, flat_lr)
+            del loss, grads
+        fast.requires_grad_(False)
+        return self.layout.unflatten(fast)
+
+    def evaluate(self, x_spt, y_spt, x_qry):
+        """
+        Query logits of one task after adapting to its support set, for meta-testing.
+        Only the support forwards build a graph, freed by torch.autograd.grad at every
+        step, and the query forward runs under inference mode.
+        """
+        params = dict(self.net.named_parameters())
+        buffers = {k: b.clone() for k, b in self.net.named_buffers()}
+        with torch.no_grad():
+            h_spt = self._body(params, buffers, x_spt)
+        fast_params = self.fast_weights(params, buffers, h_spt, y_spt)
+        with torch.inference_mode():
+            h_qry = self._body(params, buffers, x_qry)
+            return self._head({**params, **fast_params}, buffers, h_qry)
@@ -9,6 +9,116 @@ from torch.utils.data import Dataset, Sampler
 from datasets import QueryDataset
 
 
+def episodic_collate(
+    input_data: List[Tuple[Tensor, Tensor, Tensor, Tensor]],
+    cur_task: List[int],
+    n_shot: int,
+    n_query: int,
+    batch_size: int,
+    add_side_noise: bool,
+    args=None,
+) -> Tuple[Tensor, Tensor, Tensor, Tensor, List[int]]:
+    """
+    Collates the windows of one task, sampled as [n_shot + n_query] x [batch_size],
+    into support and query sets with binary labels for the variations in cur_task.
+    """
+    all_images = torch.cat([x[0].unsqueeze(0) for x in input_data])
+    all_labels = torch.cat([x[1].unsqueeze(0) for x in input_data])
+
+    all_images = all_images.reshape(
+        (
+            1,
+            n_shot + n_query,
+            batch_size,
+            *all_images.shape[1:],
+        )
+    )
+    all_labels = all_labels.reshape(
+        (
+            1,
+            n_shot + n_query,
+            batch_size,
+            *all_labels.shape[1:],
+        )
+    )
+
+    # Separate support and query sets
+    support_images = all_images[:, :n_shot].reshape(
+        (-1, *all_images.shape[2:])
+    )
+    query_images = all_images[:, n_shot:].reshape(
+        (-1, *all_images.shape[2:])
+    )
+
+    support_labels = all_labels[:, :n_shot].reshape(
+        (-1, *all_labels.shape[2:])
+    )
+    query_labels = all_labels[:, n_shot:].reshape(
+        (-1, *all_labels.shape[2:])
+    )
+    if add_side_noise:
+        # if it has side noise, label 0 is the side noise, and other label is original label +1:
+        # so if the label is not 0, its 1 (1 as >0)
+        # NOTE: VERSION 2
+        # based on the cur_task randomly select from data correspondence to make the label 1 or 0
+
+        # randomlist = torch.tensor(randomlist)
+        # print(cur_task)
+        if args.fine_split:
+            assert (
+                args.out_channels == 3
+            ), "Fine split is only available for 3 channels, but you have {}".format(
+                args.out_channels
+            )
+            # if it is in cur_task 1, if not (and originally 0) is 0, all other is 2
+            support_labels_temp = torch.isin(
+                support_labels, torch.tensor(cur_task)
+            ).to(torch.long)
+            support_labels = torch.where(
+                (support_labels_temp == 0) & (support_labels == 0),
+                2,
+                support_labels_temp,
+            )
+
+            query_labels_temp = torch.isin(
+                query_labels, torch.tensor(cur_task)
+            ).to(torch.long)
+            query_labels = torch.where(
+                (query_labels_temp == 0) & (query_labels == 0),
+                2,
+                query_labels_temp,
+            )
+        else:
+            support_labels = torch.isin(
+                support_labels, torch.tensor(cur_task)
+            ).to(torch.long)
+            query_labels = torch.isin(
+                query_labels, torch.tensor(cur_task)
+            ).to(torch.long)
+        # NOTE: VERSION 1
+        # query_labels = torch.where(query_labels > 0, 1, 0)
+        # support_labels = torch.where(support_labels > 0, 1, 0)
+        # NOTE: VERSION 3
+        # query_labels = torch.where(query_labels == cur_task, 1, 0)
+        # support_labels = torch.where(support_labels == cur_task, 1, 0)
+
+    else:
+        # Adjust labels to binary based on the current target variation
+        raise NotImplementedError(
+            "Binary label adjustment is not implemented yet."
+        )
+        # query_labels = torch.where(query_labels == cur_task, 1, 0)
+        # support_labels = torch.where(support_labels == cur_task, 1, 0)
+
+    return (
+        support_images,
+        support_labels,
+        query_images,
+        query_labels,
+        [cur_task],
+    )
+
+
 class DenseLabelTaskSampler(Sampler):
     """
     Samples batches for one-way few-shot tasks, focusing on one variation of the exercise per iteration.
@@ -45,28 +155,37 @@ class DenseLabelTaskSampler(Sampler):
         self.threshold_ratio = threshold_ratio
         self._cur_task = []
         self.dataset = dataset
-        self.items_per_label: Dict[int, List[int]] = {}
+        self.items_per_label: Dict[int, np.ndarray] = {}
         self.add_side_noise = add_side_noise
         self.args = args
 
-        # Build a dictionary mapping each label to a list of indices for dense labeling
-        for item_idx, (input_data, label, exer_label, var_label) in enumerate(
-            dataset
-        ):
-            # NOTE: QUESTION should we consider in the label of variation or the label of the exercise?
-            # NOTE: VERSION 1
-            # valid_label = self._classify_label(label)
-            # NOTE: VERSION 2
-            valid_label = int(exer_label)  # self._get_label(label)
-            # NOTE: VERSION 3
-            # valid_label = int(var_label) #exer_label # self._get_label(label)
-            if valid_label is not None:
-                if valid_label in self.items_per_label:
-                    self.items_per_label[valid_label].append(item_idx)
-                else:
-                    self.items_per_label[valid_label] = [item_idx]
+        # Build a dictionary mapping each label to an array of indices for dense labeling,
+        # from the per-window labels only (the signal and its transforms are not touched)
+        exer_label, var_label = dataset.raw_labels()
+        # NOTE: QUESTION should we consider in the label of variation or the label of the exercise?
+        # NOTE: VERSION 1
+        # valid_label = self._classify_label(label)
+        # NOTE: VERSION 2
+        valid_labels = np.asarray(exer_label)  # self._get_label(label)
+        # NOTE: VERSION 3
+        # valid_labels = np.asarray(var_label) #exer_label # self._get_label(label)
+        order = np.argsort(valid_labels, kind="stable")
+        values, group_starts = np.unique(valid_labels[order], return_index=True)
+        groups = np.split(order, group_starts[1:])
+        # keep the labels in order of first appearance, as random.choice picks from them
+        for i in np.argsort([group[0] for group in groups]):
+            self.items_per_label[int(values[i])] = groups[i]
         self._check_dataset_size_fits_sampler_parameters()
 
+        # Count every variation label in every window once, so tasks are sampled by lookup
+        # (a tensor, so DataLoader workers get it through shared memory rather than a copy)
+        num_var_labels = (
+            max(max(v) for v in dataset.data_correspondence().values()) + 1
+        )
+        self.label_counts = torch.from_numpy(
+            dataset.dense_label_counts(num_var_labels)
+        )
+
     def __len__(self) -> int:
         return self.n_tasks
 
@@ -105,44 +224,26 @@ class DenseLabelTaskSampler(Sampler):
             # Step 4: Retrieve all candidate indices for the selected key
             candidate_indices = self.items_per_label[rand_key]
 
-            # Step 5: Randomize the candidate list
-            randomed_candidate = random.sample(
-                candidate_indices, len(candidate_indices)
-            )
+            # Step 5: Count occurrences of any rand_var in the dense labels of each candidate
+            rand_var_count = self.label_counts[candidate_indices][:, rand_vars].sum(axis=1)
+
+            # Step 6: Keep the candidates with at least 100 labels as rand_var
+            filtered_candidates = candidate_indices[
+                (rand_var_count >= 100).numpy()
+            ]  # 0.1 * dense_labels.numel(): # frequnecy 50 and 2 sec
 
-            # Step 6: Initialize a list to store filtered indices
-            filtered_indices = []
-
-            # Step 7: Iterate through randomized candidates and filter based on dense label criteria
-            for idx in randomed_candidate:
-                dense_labels = self.dataset[idx][1]
-
-                # Ensure dense_labels is a Tensor
-                if not isinstance(dense_labels, torch.Tensor):
-                    dense_labels = torch.tensor(dense_labels)
-
-                # Count occurrences of any rand_var in dense_labels
-                # This assumes rand_vars are scalar values that can be directly compared
-                matches = torch.zeros_like(dense_labels, dtype=torch.bool)
-                for var in rand_vars:
-                    matches |= dense_labels == var
-                rand_var_count = matches.sum().item()
-
-                # Check if at least 10% of the labels are rand_var
-                if (
-                    rand_var_count >= 100
-                ):  # 0.1 * dense_labels.numel(): # frequnecy 50 and 2 sec
-                    filtered_indices.append(idx)
-                    if len(filtered_indices) == total_samples:
-                        break
-
-            # Step 8: Check if enough samples are available
-            if len(filtered_indices) < total_samples:
+            # Step 7: Check if enough samples are available
+            if len(filtered_candidates) < total_samples:
                 raise ValueError(
                     f"Not enough samples with at least 10% of labels as {rand_vars}. "
-                    f"Required: {total_samples}, Available: {len(filtered_indices)}"
+                    f"Required: {total_samples}, Available: {len(filtered_candidates)}"
                 )
 
+            # Step 8: Randomly pick the samples of this task among them
+            filtered_indices = np.random.choice(
+                filtered_candidates, total_samples, replace=False
+            ).tolist()
+
             # Step 9: Assign the current task's rand_vars
             self._cur_task = rand_vars
             # Step 10: Yield the filtered indices for this task
@@ -154,100 +255,14 @@ class DenseLabelTaskSampler(Sampler):
         """
         Collate function for episodic data loaders in dense labeling problems.
         """
-        all_images = torch.cat([x[0].unsqueeze(0) for x in input_data])
-        all_labels = torch.cat([x[1].unsqueeze(0) for x in input_data])
-
-        all_images = all_images.reshape(
-            (
-                1,
-                self.n_shot + self.n_query,
-                self.batch_size,
-                *all_images.shape[1:],
-            )
-        )
-        all_labels = all_labels.reshape(
-            (
-                1,
-                self.n_shot + self.n_query,
-                self.batch_size,
-                *all_labels.shape[1:],
-            )
-        )
-
-        # Separate support and query sets
-        support_images = all_images[:, : self.n_shot].reshape(
-            (-1, *all_images.shape[2:])
-        )
-        query_images = all_images[:, self.n_shot :].reshape(
-            (-1, *all_images.shape[2:])
-        )
-
-        support_labels = all_labels[:, : self.n_shot].reshape(
-            (-1, *all_labels.shape[2:])
-        )
-        query_labels = all_labels[:, self.n_shot :].reshape(
-            (-1, *all_labels.shape[2:])
-        )
-        if self.add_side_noise:
-            # if it has side noise, label 0 is the side noise, and other label is original label +1:
-            # so if the label is not 0, its 1 (1 as >0)
-            # NOTE: VERSION 2
-            # based on the _cur_task randomly select from data correspondence to make the label 1 or 0
-
-            # randomlist = torch.tensor(randomlist)
-            # print(self._cur_task)
-            if self.args.fine_split:
-                assert (
-                    self.args.out_channels == 3
-                ), "Fine split is only available for 3 channels, but you have {}".format(
-                    self.args.out_channels
-                )
-                # if it is in cur_task 1, if not (and originally 0) is 0, all other is 2
-                support_labels_temp = torch.isin(
-                    support_labels, torch.tensor(self._cur_task)
-                ).to(torch.long)
-                support_labels = torch.where(
-                    (support_labels_temp == 0) & (support_labels == 0),
-                    2,
-                    support_labels_temp,
-                )
-
-                query_labels_temp = torch.isin(
-                    query_labels, torch.tensor(self._cur_task)
-                ).to(torch.long)
-                query_labels = torch.where(
-                    (query_labels_temp == 0) & (query_labels == 0),
-                    2,
-                    query_labels_temp,
-                )
-            else:
-                support_labels = torch.isin(
-                    support_labels, torch.tensor(self._cur_task)
-                ).to(torch.long)
-                query_labels = torch.isin(
-                    query_labels, torch.tensor(self._cur_task)
-                ).to(torch.long)
-            # NOTE: VERSION 1
-            # query_labels = torch.where(query_labels > 0, 1, 0)
-            # support_labels = torch.where(support_labels > 0, 1, 0)
-            # NOTE: VERSION 3
-            # query_labels = torch.where(query_labels == self._cur_task, 1, 0)
-            # support_labels = torch.where(support_labels == self._cur_task, 1, 0)
-
-        else:
-            # Adjust labels to binary based on the current target variation
-            raise NotImplementedError(
-                "Binary label adjustment is not implemented yet."
-            )
-            # query_labels = torch.where(query_labels == self._cur_task, 1, 0)
-            # support_labels = torch.where(support_labels == self._cur_task, 1, 0)
-
-        return (
-            support_images,
-            support_labels,
-            query_images,
-            query_labels,
-            [self._cur_task],
+        return episodic_collate(
+            input_data,
+            self._cur_task,
+            self.n_shot,
+            self.n_query,
+            self.batch_size,
+            self.add_side_noise,
+            self.args,
         )
 
     def _get_label(self, label: Tensor) -> int:
@@ -0,0 +1,114 @@
+# EpisodePrefetcher.py
+import queue
+import threading
+
+import torch
+
+
+def _pin(batch):
+    return tuple(
+        t.pin_memory() if torch.is_tensor(t) and not t.is_pinned() else t
+        for t in batch
+    )
+
+
+def _to_device(batch, device, non_blocking):
+    return tuple(
+        t.to(device, non_blocking=non_blocking) if torch.is_tensor(t) else t
+        for t in batch
+    )
+
+
+def _put(ready, stop, item):
+    # blocks until the item is queued or the prefetcher is closed
+    while not stop.is_set():
+        try:
+            ready.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _produce(episodes, ready, stop, device, stream):
+    # runs in the background thread, without a reference to the prefetcher
+    try:
+        for batch in episodes:
+            event = None
+            if stream is not None:
+                with torch.cuda.stream(stream):
+                    batch = _to_device(_pin(batch), device, non_blocking=True)
+                event = torch.cuda.Event()
+                event.record(stream)
+            else:
+                batch = _to_device(batch, device, non_blocking=False)
+            if not _put(ready, stop, (batch, event, None)):
+                return
+    except Exception as e:
+        _put(ready, stop, (None, None, e))
+        return
+    _put(ready, stop, (None, None, StopIteration()))
+
+
+class EpisodePrefetcher:
+    """
+    Iterator over the episodes of a task DataLoader, moved to the device ahead of time.
+
+    A background thread samples and collates up to depth episodes while the current one
+    is trained on. On CUDA, the episodes are pinned and copied with non_blocking copies on
+    a side stream, which the stream of the training waits for. With depth 0, the episodes
+    are sampled and moved synchronously by next().
+
+    The sampler and the transforms draw from random and np.random in the background
+    thread, while the training only draws from torch's generator, so seeded runs give the
+    same episodes at any depth. A sampler must therefore not draw from torch's global
+    generator while it samples (StreamingQueryDataset draws its seed when the iterator of
+    the loader is created, on the calling thread).
+    """
+
+    def __init__(self, loader, device, depth=2):
+        self.device = torch.device(device)
+        self.depth = depth
+        self.episodes = iter(loader)
+        self.error = None
+        if depth == 0:
+            return
+        self.stream = None
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.device)
+        self.ready = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(
+            target=_produce,
+            args=(self.episodes, self.ready, self.stop, self.device, self.stream),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.depth == 0:
+            return _to_device(next(self.episodes), self.device, non_blocking=False)
+        if self.error is not None:
+            raise self.error
+        batch, event, self.error = self.ready.get()
+        if self.error is not None:
+            raise self.error
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            # the memory of the copies is now used by the stream of the training
+            for t in batch:
+                if torch.is_tensor(t) and t.is_cuda:
+                    t.record_stream(current)
+        return batch
+
+    def close(self):
+        """Stops the background thread, e.g. before the loader is exhausted."""
+        if self.depth > 0:
+            self.stop.set()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,131 @@
+# Manifest.py
+import os
+
+import numpy as np
+
+# columns of a file's unique identifier, in the order returned by parse_filename
+KEY_COLUMNS = ("subject", "exercise", "variation")
+
+
+class Manifest:
+    """
+    Columnar index of the repetition files of a dataset, one row per csv:
+    subject, exercise, variation, repetition, path, train/test split (with the position of
+    the file in its split), and the row offset/length of its signal in the SignalStore.
+
+    Rows keep the order of the files per unique identifier. The manifest is saved as a
+    plain structured .npy (no pickle), so it loads memory-mapped and splits and folds are
+    built with vectorized filters.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @classmethod
+    def from_splits(cls, subjLabel_to_data, train_files, test_files, signal_store):
+        """
+        Args:
+            subjLabel_to_data: Dictionary of unique identifier -> list of files, in order.
+            train_files: Files of the train split, in the order they are concatenated.
+            test_files: Files of the test split, in the order they are concatenated.
+            signal_store: SignalStore holding the signals of the files.
+        """
+        split_of = {f: ("train", i) for i, f in enumerate(train_files)}
+        split_of.update({f: ("test", i) for i, f in enumerate(test_files)})
+
+        records = []
+        for key, files in subjLabel_to_data.items():
+            for filename in files:
+                split, split_order = split_of.get(filename, ("", -1))
+                records.append(
+                    (*key, cls.parse_repetition(filename), filename, split, split_order)
+                )
+        paths = [record[4] for record in records]
+        dtype = [
+            ("subject", f"U{max(len(r[0]) for r in records)}"),
+            ("exercise", f"U{max(len(r[1]) for r in records)}"),
+            ("variation", f"U{max(len(r[2]) for r in records)}"),
+            ("repetition", np.int32),
+            ("path", f"U{max(len(p) for p in paths)}"),
+            ("split", "U5"),
+            ("split_order", np.int64),
+            ("offset", np.int64),
+            ("length", np.int64),
+        ]
+        rows = np.zeros(len(records), dtype=dtype)
+        columns = [*KEY_COLUMNS, "repetition", "path", "split", "split_order"]
+        for i, name in enumerate(columns):
+            rows[name] = [record[i] for record in records]
+        manifest = cls(rows)
+        manifest.refresh_offsets(signal_store)
+        return manifest
+
+    @staticmethod
+    def parse_repetition(filename):
+        # the repetition id is the last part of every dataset's filename
+        repetition = os.path.basename(filename).rstrip(".csv").split("_")[-1]
+        return int(repetition) if repetition.isdigit() else -1
+
+    @classmethod
+    def load(cls, path):
+        return cls(np.load(path, mmap_mode="r"))
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(self.rows))
+        os.replace(tmp_path, path)
+
+    def refresh_offsets(self, signal_store):
+        """
+        Points offset/length at the current SignalStore, returns whether they changed.
+        """
+        i = np.array(
+            [signal_store.index[os.path.normpath(p)] for p in self.rows["path"]]
+        )
+        offsets, lengths = signal_store.offsets[i], signal_store.lengths[i]
+        if np.array_equal(self.rows["offset"], offsets) and np.array_equal(
+            self.rows["length"], lengths
+        ):
+            return False
+        self.rows = np.array(self.rows)
+        self.rows["offset"] = offsets
+        self.rows["length"] = lengths
+        return True
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, column):
+        return self.rows[column]
+
+    def select(self, mask):
+        return Manifest(self.rows[mask])
+
+    def sort_by(self, column):
+        return Manifest(self.rows[np.argsort(self.rows[column], kind="stable")])
+
+    def unique_indices(self):
+        """Sorted (exercise, variation) labels, as the variation label indices refer to."""
+        pairs = set(zip(self.rows["exercise"].tolist(), self.rows["variation"].tolist()))
+        return sorted(pairs, key=lambda x: (int(x[0][1:]), x[1]))
+
+    def unique_subjects(self):
+        return sorted(set(self.rows["subject"].tolist()), key=lambda x: int(x[1:]))
+
+    def groups(self, columns):
+        """
+        Groups the rows by the given columns, in order of first appearance.
+        Returns a list of (key tuple, Manifest of the rows of that key, in order).
+        """
+        keys = np.stack([self.rows[c] for c in columns], axis=1)
+        _, first, inverse = np.unique(
+            keys, axis=0, return_index=True, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        members = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        return [
+            (tuple(keys[first[g]].tolist()), self.select(members[g]))
+            for g in np.argsort(first)
+        ]
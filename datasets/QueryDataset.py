@@ -1,6 +1,9 @@
 # QueryDataset.py
+import hashlib
 import os
 import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torch
@@ -8,6 +11,10 @@ from torch.utils.data import Dataset
 
 from utilities import *
 
+from .Manifest import KEY_COLUMNS, Manifest
+from .SignalStore import SignalStore
+from .WindowStore import WindowStore
+
 
 def test_data_splitting(train, test):
         # Ensure no overlapping subjects
@@ -15,6 +22,25 @@ def test_data_splitting(train, test):
         test_subjects = set(test.keys())
         assert train_subjects.isdisjoint(test_subjects), "Overlap detected between train and test subjects"
 
+# rows at the end of a repetition the side noise after it continues from
+NOISE_REFERENCE_LENGTH = 50
+
+# bump when the layout or the content of the cached window stores changes
+WINDOW_STORE_VERSION = 2
+
+# dataset shared with the ingestion worker processes, set once per worker
+_ingest_dataset = None
+
+
+def _init_ingest_worker(dataset):
+    global _ingest_dataset
+    _ingest_dataset = dataset
+
+
+def _ingest_subject(job):
+    return _ingest_dataset.ingest_subject(*job)
+
+
 class QueryDataset(Dataset):
     def __init__(
         self,
@@ -50,13 +76,18 @@ class QueryDataset(Dataset):
 
         self.sw = sliding_windows(window_size, window_step)
         # self.sw_loocv = sliding_windows(window_size, window_step//4)
-        if not self.if_npy_exists():
-            self._process_data()
-        if self.loocv and not self.if_npy_exists(loocv=True):
-            self._process_loocv_data()
-
-        self.data_dict = self.load_data()
-        self.data, self.label, self.res_exer_label, self.res_var_label = self.concatenate_data()
+        self.signal_store = SignalStore(
+            self.default_data_folders(),
+            os.path.join(self.root, self.DATASET_NAME, "signal_store"),
+        )
+        self.manifest = self.load_manifest()
+        if self.args.streaming:
+            # windows are generated on the fly by StreamingQueryDataset
+            return
+        if self.window_store_exists():
+            self.data, self.label, self.res_exer_label, self.res_var_label = self.load_window_store()
+        else:
+            self.data, self.label, self.res_exer_label, self.res_var_label = self.concatenate_data()
 
     def get_dataset_name(self):
         """
@@ -106,10 +137,9 @@ class QueryDataset(Dataset):
         Must be implemented by subclasses.
         """
         raise NotImplementedError
-    def _process_data(self):
+    def _scan_files(self):
         data_folders = self.default_data_folders()
         subjLabel_to_data = {}
-        unique_indices = []
 
         for data_folder in data_folders:
             for root_dir, _, files in os.walk(data_folder):
@@ -120,280 +150,328 @@ class QueryDataset(Dataset):
                         if identifiers is None:
                             continue  # Skip files that do not match expected pattern
 
-                        subj = identifiers["subject"]
-                        ind_label = identifiers["ind_label"]
                         unique_identifier = identifiers["unique_identifier"]
 
                         if unique_identifier not in subjLabel_to_data:
                             subjLabel_to_data[unique_identifier] = []
                         subjLabel_to_data[unique_identifier].append(filepath)
+        return subjLabel_to_data
 
-                        if ind_label not in unique_indices:
-                            unique_indices.append(ind_label)
-        unique_indices = sorted(
-            unique_indices, key=lambda x: (int(x[0][1:]), x[1])
-        )
+    def legacy_npy_path(self, name):
+        return os.path.join(self.root, self.DATASET_NAME, f"{name}_data.npy")
 
-        # Proceed with splitting data into train/test and saving
-        seed(self.args.dataset_seed)
-        train_data = {}
-        train_label = {}
-        test_data = {}
-        test_label = {}
-        for k, v in subjLabel_to_data.items():
-            random_indices = random.sample(range(len(v)), int(0.2 * len(v)))
-            subj = tuple([k[i] for i in self.get_subject()])
-            ind_label = tuple([k[i] for i in self.get_ind_label()])
-            if subj not in train_data:
-                train_data[subj] = []
-                train_label[subj] = []
-                test_data[subj] = []
-                test_label[subj] = []
-            train_data[subj].extend(
-                [v[i] for i in range(len(v)) if i not in random_indices]
-            )
-            train_label[subj].extend(
-                [
-                    unique_indices.index(ind_label)
-                    for i in range(len(v))
-                    if i not in random_indices
-                ]
-            )
-            test_data[subj].extend(
-                [v[i] for i in range(len(v)) if i in random_indices]
-            )
-            test_label[subj].extend(
-                [
-                    unique_indices.index(ind_label)
-                    for i in range(len(v))
-                    if i in random_indices
-                ]
-            )
-
-        train = {
-            "data": train_data,
-            "label": train_label,
-            "unique_indices": unique_indices,
-            "info": "Processed data",
-        }
-
-        test = {
-            "data": test_data,
-            "label": test_label,
-            "unique_indices": unique_indices,
-            "info": "Processed data",
-        }
-
-        # Save processed data
-        np.save(
-            os.path.join(self.root, self.DATASET_NAME, "train_data.npy"),
-            train,
-            allow_pickle=True,
-        )
-        np.save(
-            os.path.join(self.root, self.DATASET_NAME, "test_data.npy"),
-            test,
-            allow_pickle=True,
-        )
+    def _process_data(self):
+        """
+        Builds the manifest: every csv of the dataset with its train/test split.
+        Splits saved as pickled train_data.npy / test_data.npy / loocv_data.npy by earlier
+        versions are carried over, so existing experiments keep the same files.
+        """
+        if os.path.exists(self.legacy_npy_path("loocv")):
+            subjLabel_to_data = np.load(
+                self.legacy_npy_path("loocv"), allow_pickle=True
+            ).item()["subjLabel_to_data"]
+        else:
+            subjLabel_to_data = self._scan_files()
+
+        if all(
+            os.path.exists(self.legacy_npy_path(split)) for split in ["train", "test"]
+        ):
+            train_data = np.load(
+                self.legacy_npy_path("train"), allow_pickle=True
+            ).item()["data"]
+            test_data = np.load(
+                self.legacy_npy_path("test"), allow_pickle=True
+            ).item()["data"]
+        else:
+            # Proceed with splitting data into train/test
+            rng = random.Random(self.args.dataset_seed)
+            train_data = {}
+            test_data = {}
+            for k, v in subjLabel_to_data.items():
+                random_indices = rng.sample(range(len(v)), int(0.2 * len(v)))
+                subj = tuple([k[i] for i in self.get_subject()])
+                if subj not in train_data:
+                    train_data[subj] = []
+                    test_data[subj] = []
+                train_data[subj].extend(
+                    [v[i] for i in range(len(v)) if i not in random_indices]
+                )
+                test_data[subj].extend(
+                    [v[i] for i in range(len(v)) if i in random_indices]
+                )
 
-    def _process_loocv_data(self):
-        loocv_data_path = os.path.join(
-            self.root, self.DATASET_NAME, "loocv_data.npy"
+        manifest = Manifest.from_splits(
+            subjLabel_to_data,
+            [f for files in train_data.values() for f in files],
+            [f for files in test_data.values() for f in files],
+            self.signal_store,
         )
-        if os.path.exists(loocv_data_path):
-            print("LOOCV data already processed. Skipping processing.")
-            return  # Data already processed
-        
-        data_folders = self.default_data_folders()
-        subjLabel_to_data = {}
-        unique_indices = []
-
-        for data_folder in data_folders:
-            for root_dir, _, files in os.walk(data_folder):
-                for file in files:
-                    if file.endswith(".csv"):
-                        filepath = os.path.join(root_dir, file)
-                        identifiers = self.parse_filename(file)
-                        if identifiers is None:
-                            continue
+        manifest.save(self.manifest_path())
+        return manifest
 
-                        subj = identifiers["subject"]
-                        ind_label = identifiers["ind_label"]
-                        unique_identifier = identifiers["unique_identifier"]
+    def manifest_path(self):
+        return os.path.join(self.root, self.DATASET_NAME, "manifest.npy")
 
-                        if unique_identifier not in subjLabel_to_data:
-                            subjLabel_to_data[unique_identifier] = []
-                        subjLabel_to_data[unique_identifier].append(filepath)
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path()):
+            return self._process_data()
+        manifest = Manifest.load(self.manifest_path())
+        if manifest.refresh_offsets(self.signal_store):
+            manifest.save(self.manifest_path())
+        return manifest
 
-                        if ind_label not in unique_indices:
-                            unique_indices.append(ind_label)
-        unique_indices = sorted(
-            unique_indices, key=lambda x: (int(x[0][1:]), x[1])
-        )
-        # Save the processed data
-        loocv_data = {
-            "subjLabel_to_data": subjLabel_to_data,
-            "unique_indices": unique_indices,
-            "info": "LOOCV processed data",
-        }
-        np.save(loocv_data_path, loocv_data, allow_pickle=True)
-
-    def if_npy_exists(self, loocv=False):
-        if loocv:
-            return os.path.exists(
-                os.path.join(self.root, self.DATASET_NAME, "loocv_data.npy")
-            )
-        else:
-            return all(
-                os.path.exists(
-                    os.path.join(
-                        self.root, self.DATASET_NAME, f"{split}_data.npy"
-                    )
-                )
-                for split in ["train", "test"]
+    def labeled_files(self, rows, unique_indices):
+        """
+        (filename, variation label) pairs of the given manifest rows.
+        """
+        return [
+            (path, unique_indices.index((exercise, variation)))
+            for path, exercise, variation in zip(
+                rows["path"].tolist(),
+                rows["exercise"].tolist(),
+                rows["variation"].tolist(),
             )
-
-    def load_data(self):
-        if self.loocv:
-            data = np.load(
-                os.path.join(self.root, self.DATASET_NAME, "loocv_data.npy"),
-                allow_pickle=True,
-            ).item()
-        else:
-            data = np.load(
-                os.path.join(
-                    self.root, self.DATASET_NAME, f"{self.split}_data.npy"
-                ),
-                allow_pickle=True,
-            ).item()
-        return data
+        ]
 
     def concatenate_data(self):
-        seed(self.args.dataset_seed)
         if self.loocv:
             return self._loocv_concatenate_data()
         else:
             return self._normal_concatenate_data()
 
+    def subject_jobs(self):
+        """
+        The (key, [(filename, variation label)], noise chance) job of every subject stream
+        of the split, in the order they are concatenated.
+        """
+        if self.loocv:
+            return self._loocv_subject_jobs()
+        return self._normal_subject_jobs()
+
+    def _normal_subject_jobs(self):
+        unique_indices = self.manifest.unique_indices()
+        rows = self.manifest.select(self.manifest["split"] == self.split)
+        rows = rows.sort_by("split_order")
+        return [
+            (k, self.labeled_files(v, unique_indices), 1.0)
+            for k, v in rows.groups([KEY_COLUMNS[i] for i in self.get_subject()])
+        ]
+
     def _normal_concatenate_data(self):
-        data = self.data_dict["data"]
-        label = self.data_dict["label"]
-        unique_indices = self.data_dict["unique_indices"]
+        unique_indices = self.manifest.unique_indices()
         exercise_labels = sorted(set([label[0] for label in unique_indices]))
 
         res_data = []
         res_label = []
         res_exer_label = []
         res_var_label = []
-        for k, v in data.items():
-            file = []
-            dense_label = []
-            k_label = label[k]
-            combined = list(zip(v, k_label))
-            if self.args.shuffle == "random" or self.args.shuffle == "random_variation":
-                random.shuffle(combined)
-            elif self.args.shuffle == "sorted":
-                combined = sort_filename(combined)
-            else:
-                raise NotImplementedError
-
-            for filename, original_label in combined:
-                df_np = pd.read_csv(filename).to_numpy()[:, 1:7]
-                file.append(df_np)
-                dense_label.append([original_label] * df_np.shape[0])
-
-                if self.args.add_side_noise:
-                    noise = self.generate_noise(df_np, self.args.noise_type)
-                    file.append(noise)
-                    dense_label.append([-1] * noise.shape[0])
-
-            file = np.concatenate(file, axis=0)
-            dense_label = np.concatenate(dense_label, axis=0)
-
-            if self.args.add_side_noise:
-                dense_label = dense_label + 1
-
-            sfile, sdense_label = self.sw(
-                torch.tensor(file), torch.tensor(dense_label)
-            )
-            res_data.append(sfile)
-            res_label.append(sdense_label)
+        jobs = self._normal_subject_jobs()
+        for file, dense_label, original_label in self.ingest_subjects(jobs):
+            num_windows = len(self.sw.window_starts(file.shape[0]))
+            res_data.append(file)
+            res_label.append(dense_label)
             res_exer_label.append(
                 torch.tensor(
                     [exercise_labels.index(unique_indices[original_label][0])]
-                    * sfile.shape[0]
+                    * num_windows
                 )
             )
             res_var_label.append(
-                torch.tensor([original_label] * sfile.shape[0]))
+                torch.tensor([original_label] * num_windows))
             # res_var_label.append(
             #     torch.tensor(
-            #         [unique_indices[original_label][1]] * sfile.shape[0]
+            #         [unique_indices[original_label][1]] * num_windows
             #     )
             # )
 
-        res_data = torch.cat(res_data, axis=0)
-        res_label = torch.cat(res_label, axis=0)
         res_exer_label = torch.cat(res_exer_label, axis=0)
         res_var_label = torch.cat(res_var_label, axis=0)
-        return res_data, res_label, res_exer_label, res_var_label
+        return self.build_window_store(
+            res_data, res_label, res_exer_label, res_var_label
+        )
 
 
+    def subject_seed(self, key):
+        """
+        Seed for shuffling and adding noise to one subject, independent of the order
+        (or the worker) in which the subjects are processed.
+        """
+        digest = hashlib.md5(repr((self.args.dataset_seed, key)).encode()).hexdigest()
+        return int(digest[:8], 16)
+
+    def subject_segments(self, key, combined, noise_chance=1.0, chunk_size=None):
+        """
+        Shuffles the (filename, label) pairs of one subject and yields its stream in order,
+        as (signal, dense label, repetition label) segments: each repetition in chunks of at
+        most chunk_size rows, followed by its side noise.
+
+        The shuffle and the noise are drawn from generators of their own, seeded per
+        subject, so the global random and np.random are left to the transforms.
+        """
+        subject_seed = self.subject_seed(key)
+        rng = random.Random(subject_seed)
+        np_rng = np.random.RandomState(subject_seed)
+
+        if self.args.shuffle == "random" or self.args.shuffle == "random_variation":
+            rng.shuffle(combined)
+        elif self.args.shuffle == "sorted":
+            combined = sort_filename(combined)
+        else:
+            raise NotImplementedError
+
+        # the side noise of the whole subject is generated at once
+        noises = [None] * len(combined)
+        if self.args.add_side_noise:
+            noisy = [i for i in range(len(combined)) if rng.random() < noise_chance]
+            if noisy:
+                references = [
+                    self.signal_store.read(combined[i][0], -NOISE_REFERENCE_LENGTH)
+                    for i in noisy
+                ]
+                noise, offsets = self.generate_noise_batch(
+                    references, self.args.noise_type, rng=rng, np_rng=np_rng
+                )
+                for k, i in enumerate(noisy):
+                    noises[i] = noise[offsets[k] : offsets[k + 1]]
+
+        # with side noise, label 0 is the noise and the repetitions are shifted by one
+        shift = 1 if self.args.add_side_noise else 0
+        for (filename, original_label), noise in zip(combined, noises):
+            for df_np in self.signal_store.read_chunks(filename, chunk_size):
+                yield df_np, np.full(df_np.shape[0], original_label + shift), original_label
+            if noise is not None:
+                yield noise, np.zeros(noise.shape[0], dtype=int), original_label
+
+    def ingest_subject(self, key, combined, noise_chance=1.0):
+        """
+        Concatenates the segments of one subject into a single padded stream.
+        Returns the stream, its dense label and the label of the last repetition.
+        """
+        file, dense_label, original_labels = zip(
+            *self.subject_segments(key, combined, noise_chance)
+        )
+        file = np.concatenate(file, axis=0)
+        dense_label = np.concatenate(dense_label, axis=0)
+        return self.sw.pad(file), self.sw.pad(dense_label), original_labels[-1]
+
+    def ingest_subjects(self, jobs):
+        """
+        Runs ingest_subject for every (key, combined, noise_chance) job, fanned out over
+        --ingest_workers processes when more than one is requested.
+        """
+        if self.args.ingest_workers <= 1:
+            return [self.ingest_subject(*job) for job in jobs]
+        with ProcessPoolExecutor(
+            max_workers=self.args.ingest_workers,
+            initializer=_init_ingest_worker,
+            initargs=(self,),
+        ) as executor:
+            return list(executor.map(_ingest_subject, jobs))
+
+    def window_store_key(self):
+        config = (
+            WINDOW_STORE_VERSION,
+            self.split,
+            self.loocv,
+            self.test_subject,
+            self.window_size,
+            self.window_step,
+            self.args.shuffle,
+            self.args.add_side_noise,
+            self.args.noise_type,
+            self.args.dataset_seed,
+        )
+        return hashlib.md5(repr(config).encode()).hexdigest()
+
+    def window_store_dir(self):
+        # one folder per version of the csv files, stale folders are removed on rebuild
+        return os.path.join(
+            self.root, self.DATASET_NAME, "window_store", self.signal_store.key
+        )
+
+    def window_store_path(self, name):
+        return os.path.join(
+            self.window_store_dir(), f"{self.window_store_key()}_{name}"
+        )
+
+    def window_store_exists(self):
+        return all(
+            os.path.exists(self.window_store_path(name))
+            for name in ["data.npy", "label.npy", "index.npz"]
+        )
+
+    def build_window_store(self, streams, dense_labels, exer_label, var_label):
+        """
+        Concatenates the padded per-subject streams into memory-mapped files, caches them
+        with the per-window labels, and returns lazy sliding window views over them.
+        """
+        starts = []
+        offset = 0
+        for stream in streams:
+            starts.append(self.sw.window_starts(stream.shape[0]) + offset)
+            offset += stream.shape[0]
+        starts = np.concatenate(starts)
+
+        store_dir = os.path.dirname(self.window_store_dir())
+        if os.path.isdir(store_dir):
+            for name in os.listdir(store_dir):
+                if name != self.signal_store.key:
+                    shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+
+        WindowStore.save(
+            self.window_store_path("data.npy"),
+            np.concatenate(streams, axis=0).astype(np.float32),
+        )
+        WindowStore.save(
+            self.window_store_path("label.npy"),
+            np.concatenate(dense_labels, axis=0),
+        )
+        # the index is written last, its presence marks a complete store
+        WindowStore.save_index(
+            self.window_store_path("index.npz"),
+            starts=starts,
+            exer_label=exer_label.numpy(),
+            var_label=var_label.numpy(),
+        )
+        return self.load_window_store()
+
+    def load_window_store(self):
+        data = np.load(self.window_store_path("data.npy"), mmap_mode="r")
+        label = np.load(self.window_store_path("label.npy"), mmap_mode="r")
+        index = np.load(self.window_store_path("index.npz"))
+        starts = index["starts"]
+        return (
+            WindowStore(data, starts, self.sw.width),
+            WindowStore(label, starts, self.sw.width),
+            torch.from_numpy(index["exer_label"]),
+            torch.from_numpy(index["var_label"]),
+        )
+
     def test_subject_filename(self):
         return '_'.join([str(i) for i in self.test_subject])
     
     
     
-    def _loocv_concatenate_data(self):
-        data_dict = self.data_dict
-        subjLabel_to_data = data_dict["subjLabel_to_data"]
-        unique_indices = data_dict["unique_indices"]
+    def _loocv_subject_jobs(self):
+        unique_indices = self.manifest.unique_indices()
 
         if self.test_subject is None:
             raise ValueError("test_subject must be specified for LOOCV")
-        unique_test_subjects = sorted(
-            set([key[0] for key in subjLabel_to_data.keys()]),
-            key=lambda x: int(x[1::]),
-        )
+        unique_test_subjects = self.manifest.unique_subjects()
         if all([i not in range(1, len(unique_test_subjects) + 1) for i in self.test_subject]):
             raise ValueError(
                 f"Test subject {self.test_subject} not found in dataset {unique_test_subjects}."
             )
 
-        # Directory to save splits for reproducibility
-        split_dir = os.path.join(
-            self.root, self.DATASET_NAME, "loocv_splits", self.test_subject_filename()
-        )
-        train_split_file = os.path.join(split_dir, "train_data.npy")
-        test_split_file = os.path.join(split_dir, "test_data.npy")
-
-        if os.path.exists(train_split_file) and os.path.exists(test_split_file):
-            # Load existing splits
-            train_data = np.load(train_split_file, allow_pickle=True).item()
-            test_data = np.load(test_split_file, allow_pickle=True).item()
-        else:
-            # Create splits and save them
-            train_data = {}
-            test_data = {}
-
-            for key, files in subjLabel_to_data.items():
-                subj = tuple([key[i] for i in self.get_subject()])
-                ind_label = tuple([key[i] for i in self.get_ind_label()])
-                if unique_test_subjects.index(subj[0]) in self.test_subject:
-                    if subj not in test_data:
-                        test_data[key] = []
-                    test_data[key].extend(files)
-                else:
-                    if key not in train_data:
-                        train_data[key] = []
-                    train_data[key].extend(files)
-            # Create directory if it doesn't exist
-            os.makedirs(split_dir, exist_ok=True)
-            # Save splits
-            np.save(train_split_file, train_data, allow_pickle=True)
-            np.save(test_split_file, test_data, allow_pickle=True)
-        # print("LOOCV splits saved at:", train_data.keys())
-        # print(test_data.keys())
+        # The fold is a filter on the subject, by its index in unique_test_subjects
+        test_subjects = [
+            unique_test_subjects[i]
+            for i in self.test_subject
+            if i < len(unique_test_subjects)
+        ]
+        is_test = np.isin(self.manifest["subject"], test_subjects)
+        train_data = dict(self.manifest.select(~is_test).groups(KEY_COLUMNS))
+        test_data = dict(self.manifest.select(is_test).groups(KEY_COLUMNS))
         # Select data based on the split
         test_data_splitting(train_data, test_data)
         if self.split == "train":
@@ -403,97 +481,72 @@ class QueryDataset(Dataset):
         else:
             raise ValueError("Invalid split")
         
+        if self.args.shuffle == "random_variation":
+            rows = self.manifest.select(is_test if self.split == "test" else ~is_test)
+            data_to_use = dict(
+                rows.groups([KEY_COLUMNS[i] for i in self.get_subject()])
+            )
+
+        return [
+            (key, self.labeled_files(rows, unique_indices), 0.5)
+            for key, rows in data_to_use.items()
+        ]
+
+    def _loocv_concatenate_data(self):
+        unique_indices = self.manifest.unique_indices()
+        jobs = self._loocv_subject_jobs()
+
         # Process data_to_use
         res_data = []
         res_label = []
         res_exer_label = []
         res_var_label = []
         exercise_labels = sorted(set([label[0] for label in unique_indices]))
-        
-        if self.args.shuffle == "random_variation":
-            new_data_to_use = {}
-            for key, files in data_to_use.items():
-                subj = tuple([key[i] for i in self.get_subject()])
-                if subj not in new_data_to_use:
-                    new_data_to_use[subj] = []
-                new_data_to_use[subj].extend(files)
-            data_to_use = new_data_to_use
-                
-            
-        
-        for key, files in data_to_use.items():
-            #NOTE VERSION 2:
-            combined = []
-            for filename in files:
-                ind = self.get_variation()
-                variation = filename.rstrip(".csv").split("/")[-1].split("_")[self.get_variation()]
-                combined.append((filename, unique_indices.index((key[1],variation))))
-                    
-            # print(combined)
-            #NOTE VERSION 1:
-            # subj = tuple([key[i] for i in self.get_subject()])
-            # ind_label = tuple([key[i] for i in self.get_ind_label()]) 
-            
-            # original_label = unique_indices.index(tuple(ind_label))
-            # combined = [(f, original_label) for f in files]
-
-            if self.args.shuffle == "random" or self.args.shuffle == "random_variation":
-                random.shuffle(combined)
-            elif self.args.shuffle == "sorted":
-                combined = sort_filename(combined)
-            else:
-                raise NotImplementedError
-
-            file = []
-            dense_label = []
-            for filename, original_label in combined:
-                df_np = pd.read_csv(filename).to_numpy()[:, 1:7]
-                file.append(df_np)
-                dense_label.append([original_label] * df_np.shape[0])
-
-                if self.args.add_side_noise:
-                    if random.random() < 0.5:
-                        noise = self.generate_noise(df_np, self.args.noise_type)
-                        file.append(noise)
-                        dense_label.append([-1] * noise.shape[0])
-
-            file = np.concatenate(file, axis=0)
-            dense_label = np.concatenate(dense_label, axis=0)
-
-            if self.args.add_side_noise:
-                dense_label = dense_label + 1
 
-            sfile, sdense_label = self.sw(
-                torch.tensor(file), torch.tensor(dense_label)
-            )
-            res_data.append(sfile)
-            res_label.append(sdense_label)
+        for (key, _, _), (file, dense_label, original_label) in zip(
+            jobs, self.ingest_subjects(jobs)
+        ):
+            num_windows = len(self.sw.window_starts(file.shape[0]))
+            res_data.append(file)
+            res_label.append(dense_label)
             #NOTE VERSION 1:
             # res_exer_label.append(
             #     torch.tensor(
-            #         [exercise_labels.index(ind_label[0])] * sfile.shape[0]
+            #         [exercise_labels.index(ind_label[0])] * num_windows
             #     )
             # )
             #NOTE VERSION 2:
             res_exer_label.append(
                 torch.tensor(
-                    [exercise_labels.index(key[1])] * sfile.shape[0]
+                    [exercise_labels.index(key[1])] * num_windows
                 )
             )
             res_var_label.append(
-                torch.tensor([original_label] * sfile.shape[0]))
+                torch.tensor([original_label] * num_windows))
             
 
-        res_data = torch.cat(res_data, axis=0)
-        res_label = torch.cat(res_label, axis=0)
         res_exer_label = torch.cat(res_exer_label, axis=0)
         res_var_label = torch.cat(res_var_label, axis=0)
         # print(res_data.shape, res_label.shape, res_exer_label.shape, res_var_label.shape)
-        return res_data, res_label, res_exer_label, res_var_label
+        return self.build_window_store(
+            res_data, res_label, res_exer_label, res_var_label
+        )
 
     def __len__(self):
         return len(self.data)
 
+    def raw_labels(self):
+        """
+        Per-window exercise and variation labels, without loading or transforming the data.
+        """
+        return self.res_exer_label, self.res_var_label
+
+    def dense_label_counts(self, num_values):
+        """
+        Occurrences of every dense label value in every window, shape (len(self), num_values).
+        """
+        return self.label.count_values(num_values)
+
     def __getitem__(self, idx):
         if self.transforms is not None:
             return (
@@ -504,59 +557,91 @@ class QueryDataset(Dataset):
             )
         return self.data[idx], self.label[idx], self.res_exer_label[idx], self.res_var_label[idx]
 
-    def generate_noise(
+    def generate_noise_batch(
         self,
-        noise,
+        references,
         noise_type,
         max_length=50,
         reference_length=10,
         mu=0,
         sigma=0.05,
+        rng=random,
+        np_rng=np.random,
     ):
         """
-        Generate noise with given shape
-        The length of the noise can vary by selecting a random length up to max_length.
-
-        Parameters:
-            noise (array): Base noise array to take reference values from.
-            max_length (int): Maximum possible length of the generated noise.
-            reference_length (int): Number of rows used to calculate the baseline min and max.
-            mu (float): Mean for white noise.
-            sigma (float): Standard deviation for white noise.
-        """
-        # Define the shape of the new noise array with a random length up to max_length
-        noise_shape = (
-            np.random.randint(
-                max_length // 5, max_length + 1
-            ),  # Random length between 1 and max_length
-            noise.shape[1],
-        )
+        Generates one noise segment after each of the references, with the segments of
+        every noise type generated in one vectorized pass. The noise is drawn
+        from rng and np_rng, random and np.random by default.
 
-        # Generate noise based on the selected noise type
-        if noise_type == "white":
-            # Generate white noise with normal distribution
-            noise = np.random.normal(mu, sigma, noise_shape)
-        elif noise_type == "static":
-            # Generate static pause noise using the last reference_length rows
-            noise = static_pause(noise, reference_length, noise_shape)
-        elif noise_type == "idle":
-            noise = idle_movement(noise, reference_length, noise_shape)
-        elif noise_type == "sudden":
-            noise = generate_sudden_change(noise, max_length)  # max_length
-        elif noise_type == "nonexercise":
-            noise = generate_nonexercise(
-                max_length * 3
-            )  # NOTE: Should be longer than max_length
-        elif noise_type == "all":
-            # randomly pick one:
-            noise_type = random.choice(
-                ["static", "idle", "sudden", "nonexercise"]
-            )
-            noise = self.generate_noise(
-                noise, noise_type, max_length, reference_length, mu, sigma
-            )
+        Returns the concatenated segments, shape (total length, 6), and the offsets of
+        each segment in them, shape (len(references) + 1,).
+        """
+        num_segments = len(references)
+        # Random length of every segment, between max_length // 5 and max_length
+        noise_lengths = np_rng.randint(
+            max_length // 5, max_length + 1, num_segments
+        )
+        if noise_type == "all":
+            noise_types = [
+                rng.choice(["static", "idle", "sudden", "nonexercise"])
+                for _ in range(num_segments)
+            ]
         else:
-            raise NotImplementedError(
-                f"Noise type {noise_type} is not implemented"
-            )
-        return noise
+            noise_types = [noise_type] * num_segments
+
+        segments = [None] * num_segments
+        for current_type in dict.fromkeys(noise_types):
+            index = [i for i, t in enumerate(noise_types) if t == current_type]
+            current_references = [references[i] for i in index]
+            if current_type == "white":
+                noise = np_rng.normal(
+                    mu, sigma, (noise_lengths[index].sum(), references[0].shape[1])
+                )
+                offsets = np.concatenate([[0], np.cumsum(noise_lengths[index])])
+            elif current_type == "static":
+                noise, offsets = generate_patterned_imu_noise_batch(
+                    current_references,
+                    noise_lengths[index],
+                    reference_length=reference_length,
+                    noise_type="static_pause",
+                    range_percentage=0.5,
+                    peak_probability=0,
+                    rng=np_rng,
+                )
+            elif current_type == "idle":
+                noise, offsets = generate_patterned_imu_noise_batch(
+                    current_references,
+                    noise_lengths[index],
+                    reference_length=reference_length,
+                    noise_type="directional_shift",
+                    range_percentage=0.5,
+                    peak_probability=0,
+                    rng=np_rng,
+                )
+            elif current_type == "sudden":
+                noise, offsets = generate_patterned_imu_noise_batch(
+                    current_references,
+                    np.full(len(index), max_length),
+                    reference_length=5,
+                    noise_type="sudden_change",
+                    range_percentage=0.5,
+                    peak_probability=0.5,
+                    peak_intensity=0.3,
+                    rng=np_rng,
+                )
+            elif current_type == "nonexercise":
+                # NOTE: Should be longer than max_length
+                noise = [
+                    generate_nonexercise(max_length * 3, rng=np_rng) for _ in index
+                ]
+                offsets = np.concatenate([[0], np.cumsum([len(n) for n in noise])])
+                noise = np.concatenate(noise, axis=0)
+            else:
+                raise NotImplementedError(
+                    f"Noise type {current_type} is not implemented"
+                )
+            for k, i in enumerate(index):
+                segments[i] = noise[offsets[k] : offsets[k + 1]]
+
+        offsets = np.concatenate([[0], np.cumsum([len(n) for n in segments])])
+        return np.concatenate(segments, axis=0), offsets
@@ -0,0 +1,127 @@
+# SignalStore.py
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+# every dataset csv is [timestamp, ax, ay, az, wx, wy, wz]
+IMU_COLUMNS = slice(1, 7)
+
+
+class SignalStore:
+    """
+    One-time float32 conversion of every csv under the dataset folders.
+
+    All files are concatenated row-wise into one contiguous (N, 6) array that is saved
+    next to the dataset, together with a per-file offset/length index. The store is keyed
+    by a hash of the path, size and modification time of every csv, so it is rebuilt
+    automatically when a source file is added, removed or edited, without reading them.
+    """
+
+    def __init__(self, data_folders, store_dir):
+        self.data_folders = data_folders
+        self.store_dir = store_dir
+        self.files = self._list_files()
+        self.key = self._files_hash()
+        if not self._exists():
+            self._build()
+        self.signals, self.offsets, self.lengths, self.index = self._load()
+
+    def _list_files(self):
+        files = []
+        for data_folder in self.data_folders:
+            for root_dir, _, names in os.walk(data_folder):
+                for name in names:
+                    if name.endswith(".csv"):
+                        files.append(os.path.normpath(os.path.join(root_dir, name)))
+        return sorted(files)
+
+    def _files_hash(self):
+        h = hashlib.md5()
+        for filename in self.files:
+            stat = os.stat(filename)
+            h.update(f"{filename}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return h.hexdigest()
+
+    def signal_path(self):
+        return os.path.join(self.store_dir, f"{self.key}_signals.npy")
+
+    def index_path(self):
+        return os.path.join(self.store_dir, f"{self.key}_index.npz")
+
+    def _exists(self):
+        return os.path.exists(self.signal_path()) and os.path.exists(
+            self.index_path()
+        )
+
+    def _build(self):
+        signals = []
+        lengths = []
+        for filename in self.files:
+            df_np = pd.read_csv(filename).to_numpy()[:, IMU_COLUMNS]
+            signals.append(df_np.astype(np.float32))
+            lengths.append(df_np.shape[0])
+        signals = np.concatenate(signals, axis=0)
+        lengths = np.array(lengths, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        # drop stores built from an older version of the csv files
+        for name in os.listdir(self.store_dir):
+            if not name.startswith(self.key):
+                os.remove(os.path.join(self.store_dir, name))
+
+        # write to a temporary file first, parallel runs may build the same store
+        tmp_signal = f"{self.signal_path()}.{os.getpid()}.tmp"
+        tmp_index = f"{self.index_path()}.{os.getpid()}.tmp"
+        with open(tmp_signal, "wb") as f:
+            np.save(f, signals)
+        with open(tmp_index, "wb") as f:
+            np.savez(
+                f, files=np.array(self.files), offsets=offsets, lengths=lengths
+            )
+        os.replace(tmp_index, self.index_path())
+        os.replace(tmp_signal, self.signal_path())
+
+    def _load(self):
+        signals = np.load(self.signal_path(), mmap_mode="r")
+        index = np.load(self.index_path())
+        offsets = index["offsets"]
+        lengths = index["lengths"]
+        file_index = {f: i for i, f in enumerate(index["files"].tolist())}
+        return signals, offsets, lengths, file_index
+
+    def __getstate__(self):
+        # reopen the memory map in worker processes instead of copying the signals
+        state = self.__dict__.copy()
+        del state["signals"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.signals = np.load(self.signal_path(), mmap_mode="r")
+
+    def __contains__(self, filename):
+        return os.path.normpath(filename) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def read(self, filename, start=None, stop=None):
+        """
+        Returns the (length, 6) float32 signal of one csv file, or the rows start:stop of it.
+        """
+        i = self.index[os.path.normpath(filename)]
+        rows = self.signals[self.offsets[i] : self.offsets[i] + self.lengths[i]]
+        return np.array(rows[start:stop])
+
+    def read_chunks(self, filename, chunk_size=None):
+        """
+        Yields the signal of one csv file in copies of at most chunk_size rows,
+        or whole when chunk_size is None.
+        """
+        length = self.lengths[self.index[os.path.normpath(filename)]]
+        chunk_size = chunk_size or max(length, 1)
+        for start in range(0, length, chunk_size):
+            yield self.read(filename, start, start + chunk_size)
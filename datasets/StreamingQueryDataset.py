@@ -0,0 +1,196 @@
+# StreamingQueryDataset.py
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from .DenseLabelTaskSampler import episodic_collate
+
+
+class StreamingQueryDataset(IterableDataset):
+    """
+    Streaming counterpart of QueryDataset, for recordings too long to hold in memory.
+
+    The subject streams of a QueryDataset built with --streaming are read chunk by chunk
+    from its SignalStore and cut into the same sliding windows as QueryDataset. Tasks are
+    sampled as in DenseLabelTaskSampler, from a bounded buffer of windows per exercise,
+    and yielded already collated, so the dataset is used with DataLoader(batch_size=None).
+    """
+
+    def __init__(
+        self,
+        dataset,
+        n_shot: int,
+        batch_size: int,
+        n_query: int,
+        n_tasks: int,
+        add_side_noise: bool,
+        chunk_size: int = 65536,
+        buffer_size: int = 1024,
+        args=None,
+    ):
+        """
+        Args:
+            dataset: QueryDataset built with --streaming, providing the subject streams.
+            n_shot: Number of examples per class in the support set.
+            batch_size: Number of batches.
+            n_query: Number of examples per class in the query set.
+            n_tasks: Number of tasks per iteration.
+            chunk_size: Maximum number of rows of a recording read at once.
+            buffer_size: Number of windows buffered per exercise before sampling a task.
+        """
+        assert (
+            n_shot == n_query
+        ), "n_shot and n_query must be equal for this sampler."
+        self.dataset = dataset
+        self.n_shot = n_shot
+        self.batch_size = batch_size
+        self.n_query = n_query
+        self.n_tasks = n_tasks
+        self.add_side_noise = add_side_noise
+        self.chunk_size = chunk_size
+        self.buffer_size = buffer_size
+        self.args = args
+        self.total_samples = (n_shot + n_query) * batch_size
+        assert (
+            buffer_size >= self.total_samples
+        ), f"buffer_size must hold a whole task ({self.total_samples} windows)"
+
+        unique_indices = dataset.manifest.unique_indices()
+        exercise_labels = sorted(set([label[0] for label in unique_indices]))
+        self.jobs = dataset.subject_jobs()
+        # every subject stream holds a single exercise
+        self.job_exercise = [
+            exercise_labels.index(unique_indices[combined[0][1]][0])
+            for _, combined, _ in self.jobs
+        ]
+        self.num_var_labels = (
+            max(max(v) for v in dataset.data_correspondence().values()) + 1
+        )
+
+    def __len__(self):
+        return self.n_tasks
+
+    def windows(self, job):
+        """
+        Yields the (window, dense label, label counts) of one subject stream, the same
+        windows QueryDataset takes from the padded stream, with one chunk in memory.
+        """
+        sw = self.dataset.sw
+        pending_x = np.zeros((0, 6), dtype=np.float32)
+        pending_y = np.zeros(0, dtype=np.int64)
+        head_x, head_y = pending_x, pending_y
+        length = 0
+        key, combined, noise_chance = job
+        segments = self.dataset.subject_segments(
+            key, list(combined), noise_chance, self.chunk_size
+        )
+        for x, y, _ in segments:
+            if length < sw.width:
+                # pad() repeats the beginning of the stream, at most one window of it
+                head_x = np.concatenate([head_x, x])[: sw.width]
+                head_y = np.concatenate([head_y, y])[: sw.width]
+            length += x.shape[0]
+            pending_x = np.concatenate([pending_x, x.astype(np.float32)])
+            pending_y = np.concatenate([pending_y, y])
+            yield from self._cut(pending_x, pending_y)
+            consumed = len(sw.window_starts(pending_x.shape[0])) * sw.step
+            pending_x, pending_y = pending_x[consumed:], pending_y[consumed:]
+
+        padding = sw.padded_length(length) - length
+        yield from self._cut(
+            np.concatenate([pending_x, head_x[:padding].astype(np.float32)]),
+            np.concatenate([pending_y, head_y[:padding]]),
+        )
+
+    def _cut(self, x, y):
+        for start in self.dataset.sw.window_starts(x.shape[0]):
+            label = y[start : start + self.dataset.sw.width]
+            yield (
+                torch.from_numpy(x[start : start + self.dataset.sw.width].copy()),
+                torch.from_numpy(label.copy()),
+                np.bincount(label, minlength=self.num_var_labels),
+            )
+
+    def _sample_task(self, buffer, exercise, rng):
+        """
+        Steps 2-8 of DenseLabelTaskSampler.__iter__ over the buffered windows of one
+        exercise. Returns the collated task, or None when too few windows fit it.
+        """
+        possible_vars = self.dataset.data_correspondence()[exercise]
+        num_vars = rng.integers(1, min(len(possible_vars), self.n_shot) + 1)
+        rand_vars = rng.choice(possible_vars, num_vars, replace=False).tolist()
+
+        counts = np.stack([window[2] for window in buffer])
+        candidates = np.flatnonzero(counts[:, rand_vars].sum(axis=1) >= 100)
+        if len(candidates) < self.total_samples:
+            if len(buffer) >= self.buffer_size:
+                # keep the buffer bounded, the oldest windows did not fit a task
+                del buffer[: self.total_samples]
+            return None
+
+        chosen = rng.choice(candidates, self.total_samples, replace=False)
+        task = []
+        for i in chosen:
+            x, y, _ = buffer[i]
+            if self.dataset.transforms is not None:
+                x = self.dataset.transforms(x)
+            task.append((x, y))
+        for i in sorted(chosen, reverse=True):
+            del buffer[i]
+        return episodic_collate(
+            task,
+            rand_vars,
+            self.n_shot,
+            self.n_query,
+            self.batch_size,
+            self.add_side_noise,
+            self.args,
+        )
+
+    def __iter__(self):
+        jobs = np.arange(len(self.jobs))
+        n_tasks = self.n_tasks
+        worker = get_worker_info()
+        if worker is not None:
+            # every DataLoader worker streams its own subjects
+            jobs = jobs[worker.id :: worker.num_workers]
+            n_tasks = len(range(worker.id, self.n_tasks, worker.num_workers))
+        # torch's RNG differs per worker and advances every epoch. The seed is drawn
+        # here, when the DataLoader creates its iterator, rather than by the first task
+        # on the prefetch thread, where it would race the training's draws.
+        rng = np.random.default_rng(torch.randint(2**31, (1,)).item())
+        return self._tasks(jobs, n_tasks, rng)
+
+    def _tasks(self, jobs, n_tasks, rng):
+        produced = 0
+        while produced < n_tasks:
+            produced_before = produced
+            buffers = {}
+            for job in rng.permutation(jobs):
+                exercise = self.job_exercise[job]
+                buffer = buffers.setdefault(exercise, [])
+                for window in self.windows(self.jobs[job]):
+                    buffer.append(window)
+                    if len(buffer) < self.buffer_size:
+                        continue
+                    task = self._sample_task(buffer, exercise, rng)
+                    if task is not None:
+                        yield task
+                        produced += 1
+                        if produced == n_tasks:
+                            return
+            # the end of the streams, sample from what is left in the buffers
+            for exercise, buffer in buffers.items():
+                while len(buffer) >= self.total_samples:
+                    task = self._sample_task(buffer, exercise, rng)
+                    if task is None:
+                        break
+                    yield task
+                    produced += 1
+                    if produced == n_tasks:
+                        return
+            if produced == produced_before:
+                raise ValueError(
+                    f"Not enough windows with at least 100 labels of a variation to "
+                    f"sample a task of {self.total_samples} windows."
+                )
@@ -1,3 +1,4 @@
+import functools
 import random
 
 import numpy as np
@@ -6,6 +7,50 @@ from scipy.interpolate import CubicSpline
 from scipy.spatial.transform import Rotation as R
 
 
+@functools.lru_cache(maxsize=None)
+def spline_basis(length, num_knots):
+    """
+    (length, num_knots) matrix taking the values at num_knots evenly spaced knots to the
+    cubic spline through them at every time step (a cubic spline is linear in its values).
+    """
+    knots = np.linspace(0, length - 1, num_knots)
+    return torch.from_numpy(CubicSpline(knots, np.eye(num_knots))(np.arange(length)))
+
+
+def spline_curves(knot_values, length):
+    """Smooth curves (N, length, ...) through the knot values (N, num_knots, ...)."""
+    basis = spline_basis(length, knot_values.shape[1])
+    basis = basis.to(device=knot_values.device, dtype=knot_values.dtype)
+    return torch.einsum("tk,nk...->nt...", basis, knot_values)
+
+
+def magnitude_warp(imu_data, knot_values):
+    """Scales every channel of the windows (N, T, C) by a smooth curve through (N, K, C)."""
+    return imu_data * spline_curves(knot_values, imu_data.shape[1]).to(imu_data.dtype)
+
+
+def time_warp(imu_data, knot_values):
+    """
+    Resamples the windows (N, T, C) with a smoothly varying speed through the knot values
+    (N, K), keeping the first and the last time step in place.
+    """
+    length = imu_data.shape[1]
+    if length < 2:
+        return imu_data
+    speed = spline_curves(knot_values, length).clamp(min=1e-2)
+    time = torch.cumsum(speed, dim=1)
+    time = time - time[:, :1]
+    time = time / time[:, -1:] * (length - 1)
+
+    # linear interpolation between the neighbouring time steps
+    lower = time.floor().long().clamp(0, length - 2)
+    weight = (time - lower).unsqueeze(-1).to(imu_data.dtype)
+    lower = lower.unsqueeze(-1).expand(-1, -1, imu_data.shape[2])
+    before = torch.gather(imu_data, 1, lower)
+    after = torch.gather(imu_data, 1, lower + 1)
+    return before + weight * (after - before)
+
+
 class IMUAugmentation:
     def __init__(
         self,
@@ -30,16 +75,24 @@ class IMUAugmentation:
         rotation = R.from_quat(q)
         return rotation.apply(v)
 
+    def random_rotation_matrix(self, size=None):
+        """Rotation matrix of a random_quaternion(), or a (size, 3, 3) batch of them."""
+        rand_nums = np.random.uniform(0, 45, size=3 if size is None else (size, 3))
+        return R.from_euler("xyz", rand_nums, degrees=True).as_matrix()
+
     def apply_rotation(self, imu_data_np):
-        """Apply rotation to IMU data."""
-        qS_prime_S = self.random_quaternion()
-        rotated_data = np.zeros(imu_data_np.shape)
-        for i in range(imu_data_np.shape[0]):
-            acc_data = imu_data_np[i, :3]
-            gyro_data = imu_data_np[i, 3:6]
-            rotated_data[i, :3] = self.rotate_vector(acc_data, qS_prime_S)
-            rotated_data[i, 3:6] = self.rotate_vector(gyro_data, qS_prime_S)
-        return rotated_data
+        """
+        Apply rotation to IMU data, a (T, 6) window or a (B, T, 6) batch of windows with
+        one rotation per window. Accelerometer and gyroscope rows are rotated by a single
+        matmul with the 3x3 rotation matrix.
+        """
+        batch_shape = imu_data_np.shape[:-2]
+        rotation = self.random_rotation_matrix(
+            int(np.prod(batch_shape)) if batch_shape else None
+        ).reshape(*batch_shape, 3, 3)
+        vectors = imu_data_np.reshape(*batch_shape, -1, 3)
+        rotated_data = vectors @ np.swapaxes(rotation, -1, -2)
+        return rotated_data.reshape(imu_data_np.shape)
 
     def apply_jitter(self, imu_data_np, sigma=0.01):
         """Add random jitter to IMU data."""
@@ -51,14 +104,17 @@ class IMUAugmentation:
         scale_factor = np.random.uniform(*scale_range)
         return imu_data_np * scale_factor
 
-    def apply_spline(self, imu_data_np):
-        """Apply cubic spline interpolation to smooth the IMU data."""
-        time_steps = np.arange(imu_data_np.shape[0])
-        augmented_data = np.zeros_like(imu_data_np)
-        for i in range(imu_data_np.shape[1]):
-            cs = CubicSpline(time_steps, imu_data_np[:, i])
-            augmented_data[:, i] = cs(time_steps)
-        return augmented_data
+    def apply_spline(self, imu_data_np, sigma=0.2, num_knots=6):
+        """Apply a random spline magnitude warp or time warp to IMU data."""
+        imu_data = torch.from_numpy(np.asarray(imu_data_np, dtype=np.float64))[None]
+        knot_values = torch.from_numpy(
+            np.random.normal(1, sigma, (1, num_knots, imu_data.shape[-1]))
+        )
+        if np.random.rand() < 0.5:
+            augmented_data = magnitude_warp(imu_data, knot_values)
+        else:
+            augmented_data = time_warp(imu_data, knot_values[..., 0])
+        return augmented_data[0].numpy().astype(imu_data_np.dtype)
 
     def __call__(self, imu_data):
         """Apply a random augmentation to 6-axis IMU data."""
@@ -80,3 +136,94 @@ class IMUAugmentation:
             imu_data_np = self.apply_spline(imu_data_np)
 
         return torch.tensor(imu_data_np)
+
+
+def euler_rotation_matrices(angles):
+    """
+    Rotation matrices (N, 3, 3) of extrinsic "xyz" euler angles (N, 3) in radians,
+    as scipy's Rotation.from_euler("xyz", angles).as_matrix().
+    """
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    one, zero = torch.ones_like(cos[:, 0]), torch.zeros_like(cos[:, 0])
+
+    def matrix(*rows):
+        return torch.stack([torch.stack(row, dim=-1) for row in rows], dim=-2)
+
+    rotation_x = matrix(
+        (one, zero, zero),
+        (zero, cos[:, 0], -sin[:, 0]),
+        (zero, sin[:, 0], cos[:, 0]),
+    )
+    rotation_y = matrix(
+        (cos[:, 1], zero, sin[:, 1]),
+        (zero, one, zero),
+        (-sin[:, 1], zero, cos[:, 1]),
+    )
+    rotation_z = matrix(
+        (cos[:, 2], -sin[:, 2], zero),
+        (sin[:, 2], cos[:, 2], zero),
+        (zero, zero, one),
+    )
+    return rotation_z @ rotation_y @ rotation_x
+
+
+class BatchIMUAugmentation:
+    """
+    IMUAugmentation for a whole batch of windows (..., T, 6) on its device, e.g. the
+    support and query sets of a task after collation. Every window draws its own
+    augmentation and parameters, and each augmentation is one tensor op over the batch.
+    """
+
+    def __init__(
+        self,
+        rotation_chance=0.5,
+        jitter_chance=0.5,
+        scaling_chance=0.5,
+        spline_chance=0.5,
+    ):
+        self.rotation_chance = rotation_chance
+        self.jitter_chance = jitter_chance
+        self.scaling_chance = scaling_chance
+        self.spline_chance = spline_chance
+
+    def __call__(
+        self, imu_data, sigma=0.01, scale_range=(0.9, 1.1), spline_sigma=0.2, num_knots=6
+    ):
+        """Apply a random augmentation to every 6-axis IMU window of the batch."""
+        shape = imu_data.shape
+        x = imu_data.reshape(-1, *shape[-2:])
+        num_windows = x.shape[0]
+        device = x.device
+
+        # the same cascade as IMUAugmentation: rotation, else jitter, else scaling, else spline
+        draws = torch.rand(num_windows, 5, device=device)
+        rotate = draws[:, 0] < self.rotation_chance
+        jitter = ~rotate & (draws[:, 1] < self.jitter_chance)
+        scale = ~rotate & ~jitter & (draws[:, 2] < self.scaling_chance)
+        spline = ~rotate & ~jitter & ~scale & (draws[:, 3] < self.spline_chance)
+        warp_time = draws[:, 4] < 0.5
+
+        angles = torch.deg2rad(torch.rand(num_windows, 3, device=device) * 45)
+        rotation = euler_rotation_matrices(angles).to(x.dtype)
+        rotated = (x.reshape(num_windows, -1, 3) @ rotation.transpose(1, 2)).reshape(
+            x.shape
+        )
+        x = torch.where(rotate[:, None, None], rotated, x)
+
+        x = torch.where(jitter[:, None, None], x + sigma * torch.randn_like(x), x)
+
+        scale_factor = torch.empty(num_windows, 1, 1, device=device, dtype=x.dtype)
+        scale_factor.uniform_(*scale_range)
+        x = torch.where(scale[:, None, None], x * scale_factor, x)
+
+        knot_values = 1 + spline_sigma * torch.randn(
+            num_windows, num_knots, x.shape[-1], device=device, dtype=x.dtype
+        )
+        x = torch.where(
+            (spline & ~warp_time)[:, None, None], magnitude_warp(x, knot_values), x
+        )
+        x = torch.where(
+            (spline & warp_time)[:, None, None], time_warp(x, knot_values[..., 0]), x
+        )
+
+        return x.reshape(shape)
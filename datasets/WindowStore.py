@@ -0,0 +1,81 @@
+# WindowStore.py
+import os
+
+import numpy as np
+import torch
+
+
+class WindowStore:
+    """
+    Sliding windows over a memory-mapped stream, sliced lazily on access.
+
+    Instead of one copy of every overlapping window, only the concatenated (padded)
+    per-subject streams are kept on disk together with the start index of each window,
+    so resident memory no longer grows with window_size / window_step.
+    """
+
+    def __init__(self, stream, starts, width):
+        self.stream = stream
+        self.starts = starts
+        self.width = width
+
+    @staticmethod
+    def save(path, stream):
+        """Writes a stream atomically and reopens it memory-mapped."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, stream)
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode="r")
+
+    @staticmethod
+    def save_index(path, **arrays):
+        """Writes the window index (starts and per-window labels) atomically."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def __getstate__(self):
+        # DataLoader workers reopen the memory-mapped stream instead of receiving a copy
+        state = self.__dict__.copy()
+        if isinstance(self.stream, np.memmap):
+            state["stream"] = self.stream.filename
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["stream"], str):
+            state["stream"] = np.load(state["stream"], mmap_mode="r")
+        self.__dict__.update(state)
+
+    @property
+    def shape(self):
+        return (len(self.starts), self.width, *self.stream.shape[1:])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def count_values(self, num_values):
+        """
+        Returns a (num_windows, num_values) matrix with the number of occurrences of each
+        integer value 0..num_values-1 in every window, from prefix sums over the stream.
+        """
+        counts = np.zeros((len(self.starts), num_values), dtype=np.int64)
+        ends = self.starts + self.width
+        for value in range(num_values):
+            prefix = np.concatenate([[0], np.cumsum(self.stream == value)])
+            counts[:, value] = prefix[ends] - prefix[self.starts]
+        return counts
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.numpy()
+        if np.ndim(idx) == 0 and not isinstance(idx, slice):
+            start = self.starts[idx]
+            return torch.from_numpy(np.array(self.stream[start : start + self.width]))
+        starts = self.starts[idx]
+        return torch.from_numpy(
+            np.asarray(self.stream[starts[:, None] + np.arange(self.width)])
+        )
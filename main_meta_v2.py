@@ -1,7 +1,10 @@
 import argparse
+import copy
+import multiprocessing
 import os
 import time
 import typing
+from concurrent.futures import ProcessPoolExecutor
 
 import higher
 import matplotlib.pyplot as plt
@@ -15,10 +18,29 @@ from torch.utils.data import DataLoader
 
 import wandb
 from datasets.DenseLabelTaskSampler import DenseLabelTaskSampler
+from datasets.EpisodePrefetcher import EpisodePrefetcher
+from datasets.StreamingQueryDataset import StreamingQueryDataset
 from MetricsAccumulator import MetricsAccumulator, MetricsAccumulator_v2
 from methods import EX, UNet
-from until_argparser import get_all_subjects, get_args, get_dataset, get_model
-from utilities import model_exception_handler, printc, seed
+from until_argparser import (
+    get_all_subjects,
+    get_args,
+    get_autocast,
+    get_batch_augmentation,
+    get_dataset,
+    get_grad_scaler,
+    get_maml,
+    get_model,
+)
+from utilities import (
+    get_rng_state,
+    model_exception_handler,
+    printc,
+    save_checkpoint,
+    seed,
+    set_rng_state,
+    upcast,
+)
 from utils_metrics import fsl_visualize_softmax, visualize_softmax
 
 
@@ -29,53 +51,67 @@ def train(db, net, epoch, args, wandb_run=None):
     net.to(args.device)
     net.train()
     compute_metrics = MetricsAccumulator(dir_name="train", n_classes=args.out_channels)
+    augmentation = get_batch_augmentation(args)
 
     for batch_idx in range(args.n_tasks):
-        start_time = time.time()
-
-        # Sample a batch of support and query images and labels
+        # Sample a batch of support and query images and labels, already on the device
         x_spt, y_spt, x_qry, y_qry, _ = next(db)
+        start_time = time.time()
 
-        # Move data to the specified device
-        x_spt, y_spt = x_spt.to(args.device), y_spt.to(args.device)
-        x_qry, y_qry = x_qry.to(args.device), y_qry.to(args.device)
+        if augmentation is not None:
+            x_spt, x_qry = augmentation(x_spt), augmentation(x_qry)
 
         task_num, setsz, h, w = x_spt.size()
         querysz = x_qry.size(1)
 
-        # Initialize the inner optimizer for adaptation
-        inner_opt = torch.optim.SGD(net.parameters(), lr=args.meta_lr)
-
         qry_losses = []
         args.meta_opt.zero_grad()
 
-        for i in range(task_num):
-            # utilize the sec-derivative gradient information for the inner loop
-            with higher.innerloop_ctx(
-                net, inner_opt, copy_initial_weights=False, track_higher_grads=True
-            ) as (fnet, diffopt):
-                # Inner-loop adaptation
-                for _ in range(args.n_inner_iter):
-                    spt_logits = fnet(x_spt[i])
-                    spt_loss = F.cross_entropy(spt_logits, y_spt[i].long())
-                    # diffopt.step(spt_loss)
-                    # diffopt.step(spt_loss, grad_callback=lambda grads: [g.detach() for g in grads])
-                    if args.fomaml:
-                        diffopt.step(spt_loss, grad_callback=lambda grads: [g.detach() if g is not None else None for g in grads])
-                    else:
-                        diffopt.step(spt_loss)
-
-                # Compute the loss and accuracy on the query set
-                qry_logits = fnet(x_qry[i])
-                qry_loss = F.cross_entropy(qry_logits, y_qry[i].long())
-                qry_losses.append(qry_loss.detach())
+        if args.meta_engine == "functional":
+            # adapt all tasks in parallel and backpropagate the summed query loss once
+            with get_autocast(args):
+                qry_logits = upcast(args.maml.query_logits(x_spt, y_spt, x_qry))
+            qry_loss = [
+                F.cross_entropy(qry_logits[i], y_qry[i].long()) for i in range(task_num)
+            ]
+            args.grad_scaler.scale(sum(qry_loss)).backward()
+            for i in range(task_num):
+                qry_losses.append(qry_loss[i].detach())
                 string_score, score = compute_metrics.update(
-                    y_qry[i].long(), qry_logits
+                    y_qry[i].long(), qry_logits[i].detach()
                 )
+        else:
+            # Initialize the inner optimizer for adaptation
+            inner_opt = torch.optim.SGD(net.parameters(), lr=args.meta_lr)
+
+            for i in range(task_num):
+                # utilize the sec-derivative gradient information for the inner loop
+                with higher.innerloop_ctx(
+                    net, inner_opt, copy_initial_weights=False, track_higher_grads=True
+                ) as (fnet, diffopt), get_autocast(args):
+                    # Inner-loop adaptation
+                    for _ in range(args.n_inner_iter):
+                        spt_logits = fnet(x_spt[i])
+                        spt_loss = F.cross_entropy(spt_logits, y_spt[i].long())
+                        # diffopt.step(spt_loss)
+                        # diffopt.step(spt_loss, grad_callback=lambda grads: [g.detach() for g in grads])
+                        if args.fomaml:
+                            diffopt.step(spt_loss, grad_callback=lambda grads: [g.detach() if g is not None else None for g in grads])
+                        else:
+                            diffopt.step(spt_loss)
+
+                    # Compute the loss and accuracy on the query set
+                    qry_logits = upcast(fnet(x_qry[i]))
+                    qry_loss = F.cross_entropy(qry_logits, y_qry[i].long())
+                    qry_losses.append(qry_loss.detach())
+                    string_score, score = compute_metrics.update(
+                        y_qry[i].long(), qry_logits
+                    )
                 # Backpropagation on query loss
-                qry_loss.backward()
+                args.grad_scaler.scale(qry_loss).backward()
 
-        args.meta_opt.step()
+        args.grad_scaler.step(args.meta_opt)
+        args.grad_scaler.update()
 
         qry_losses = sum(qry_losses) / task_num
         i = epoch + float(batch_idx) / args.n_tasks
@@ -123,13 +159,9 @@ def test(db, net, epoch, args, wandb_r=None):
     qry_losses = []
 
     for batch_idx in range(n_test_iter):
-        # Sample a batch of support and query images and labels
+        # Sample a batch of support and query images and labels, already on the device
         x_spt, y_spt, x_qry, y_qry, _ = next(db)
 
-        # Move data to the specified device
-        x_spt, y_spt = x_spt.to(args.device), y_spt.to(args.device)
-        x_qry, y_qry = x_qry.to(args.device), y_qry.to(args.device)
-
         task_num, setsz, h, w = x_spt.size()
         querysz = x_qry.size(1)
 
@@ -137,21 +169,29 @@ def test(db, net, epoch, args, wandb_r=None):
         inner_opt = torch.optim.SGD(net.parameters(), lr=args.meta_lr)
 
         for i in range(task_num):
-            with higher.innerloop_ctx(
-                net, inner_opt, track_higher_grads=False
-            ) as (fnet, diffopt):
-                # Inner-loop adaptation
-                for _ in range(args.n_inner_iter):
-                    spt_logits = fnet(x_spt[i])
-                    spt_loss = F.cross_entropy(spt_logits, y_spt[i].long())
-                    diffopt.step(spt_loss)
-
-                # Compute the query loss and accuracy
-                qry_logits = fnet(x_qry[i]).detach()
+            if args.meta_engine == "functional":
+                # autograd only on the support set, the query forward in inference mode
+                with get_autocast(args):
+                    qry_logits = args.maml.evaluate(x_spt[i], y_spt[i], x_qry[i])
+            else:
+                with higher.innerloop_ctx(
+                    net, inner_opt, track_higher_grads=False
+                ) as (fnet, diffopt), get_autocast(args):
+                    # Inner-loop adaptation
+                    for _ in range(args.n_inner_iter):
+                        spt_logits = fnet(x_spt[i])
+                        spt_loss = F.cross_entropy(spt_logits, y_spt[i].long())
+                        diffopt.step(spt_loss)
+                    with torch.inference_mode():
+                        qry_logits = fnet(x_qry[i])
+
+            # Compute the query loss and accuracy, in fp32
+            with torch.inference_mode():
+                qry_logits = upcast(qry_logits)
                 qry_loss = F.cross_entropy(
                     qry_logits, y_qry[i].long(), reduction="none"
                 )
-                qry_losses.append(qry_loss.detach())
+                qry_losses.append(qry_loss)
                 string_score, score = compute_metrics.update(
                     y_qry[i].long(), qry_logits
                 )
@@ -172,26 +212,34 @@ def test(db, net, epoch, args, wandb_r=None):
     if wandb_r is not None:
         # Log results
         wandb_r.log(res_dict)
-        log_visualization(epoch, wandb_r,net, fnet, inner_opt, args)
+        log_visualization(epoch, wandb_r, net, inner_opt, args)
     return qry_losses, res_dict
 
-def main(args):
-    # Initialize datasets
-    train_dataset, test_dataset = get_dataset(args)
-    seed(args.seed)
-    # Initialize samplers
-    train_sampler = DenseLabelTaskSampler(
-        train_dataset,
-        n_shot=args.n_shot,
-        batch_size=args.batch_size,
-        n_query=args.n_query,
-        n_tasks=args.n_tasks,
-        threshold_ratio=args.threshold_ratio,
-        add_side_noise=args.add_side_noise,
-        args=args
-    )
-    test_sampler = DenseLabelTaskSampler(
-        test_dataset,
+def get_task_loader(dataset, args):
+    """
+    DataLoader of the tasks of a dataset, sampled by DenseLabelTaskSampler or, with
+    --streaming, generated by StreamingQueryDataset.
+    """
+    if args.streaming:
+        stream = StreamingQueryDataset(
+            dataset,
+            n_shot=args.n_shot,
+            batch_size=args.batch_size,
+            n_query=args.n_query,
+            n_tasks=args.n_tasks,
+            add_side_noise=args.add_side_noise,
+            chunk_size=args.stream_chunk_size,
+            buffer_size=args.stream_buffer_size,
+            args=args,
+        )
+        return DataLoader(
+            stream,
+            batch_size=None,
+            num_workers=args.num_workers,
+            pin_memory=args.pin_memory,
+        )
+    sampler = DenseLabelTaskSampler(
+        dataset,
         n_shot=args.n_shot,
         batch_size=args.batch_size,
         n_query=args.n_query,
@@ -200,23 +248,34 @@ def main(args):
         add_side_noise=args.add_side_noise,
         args=args
     )
-
-    # Initialize DataLoader
-    train_loader = DataLoader(
-        train_dataset,
-        batch_sampler=train_sampler,
-        num_workers=args.num_workers,
-        pin_memory=args.pin_memory,
-        collate_fn=train_sampler.episodic_collate_fn,
-    )
-    test_loader = DataLoader(
-        test_dataset,
-        batch_sampler=test_sampler,
+    return DataLoader(
+        dataset,
+        batch_sampler=sampler,
         num_workers=args.num_workers,
         pin_memory=args.pin_memory,
-        collate_fn=test_sampler.episodic_collate_fn,
+        collate_fn=sampler.episodic_collate_fn,
     )
 
+def get_episodes(loader, args):
+    """
+    Episodes of a task loader for train() and test(), on args.device and prefetched by
+    EpisodePrefetcher.
+    """
+    return EpisodePrefetcher(loader, args.device, depth=args.prefetch)
+
+def main(args, datasets=None):
+    """
+    Trains and tests a model, on the (train, test) datasets if given, e.g. shared by the
+    trials of sweep.py. Returns the test results of the epoch with the lowest query loss
+    (see run_fold).
+    """
+    # Initialize datasets
+    train_dataset, test_dataset = datasets or get_dataset(args)
+    seed(args.seed)
+    # Initialize DataLoader
+    train_loader = get_task_loader(train_dataset, args)
+    test_loader = get_task_loader(test_dataset, args)
+
     # save 10 samples of data for visualization 
     capture_test_dataset_samples(args, test_dataset, test_loader)
     
@@ -225,8 +284,12 @@ def main(args):
 
     model.to(args.device)  # Move model to specified device
     
-    # Initialize meta optimizer
-    args.meta_opt = torch.optim.Adam(model.parameters(), lr=args.lr)
+    # Initialize meta optimizer, with the learned inner-loop learning rates if any
+    args.maml = get_maml(model, args)
+    args.meta_opt = torch.optim.Adam(
+        [*model.parameters(), *args.maml.parameters()], lr=args.lr
+    )
+    args.grad_scaler = get_grad_scaler(args)
     if not args.nowandb:
         run = wandb.init(
             project=args.wandb_project,
@@ -237,111 +300,242 @@ def main(args):
         model_path = "saved_model/" + run.name + ".pth"
     else:
         run = None
-        model_path = "saved_model/" + args.model + ".pth"
+        model_path = f"saved_model/{args.model}-{args.dataset}-{args.seed}.pth"
     model_exception_handler(model_path)
 
     # Training loop
+    result = fit(model, train_loader, test_loader, args, run, model_path)
+    if not args.nowandb:
+        log_model_artifact(run, model_path)
+        run.finish()
+    return result
+
+# arguments that do not change the training, and may differ when it is resumed
+RESUMABLE_ARGS = {
+    "resume",
+    "checkpoint_interval",
+    "n_epochs",
+    "device",
+    "num_workers",
+    "ingest_workers",
+    "pin_memory",
+    "prefetch",
+    "loocv_workers",
+    "loocv_threads",
+    "log_interval",
+    "wandb_project",
+    "nowandb",
+}
+
+def checkpoint_args(args):
+    # the command-line arguments of the training, without the values set on args at run
+    # time (e.g. the wandb group of __main__, or the optimizers)
+    names = vars(get_args(["--dataset", args.dataset, "--model", args.model]))
+    return {k: getattr(args, k) for k in names if k not in RESUMABLE_ARGS}
+
+def fit(model, train_loader, test_loader, args, run, model_path):
+    """
+    Trains and tests the model for args.n_epochs, saving the weights of the epoch with the
+    lowest query loss to model_path, and returns the test results of that epoch.
+
+    Every --checkpoint_interval epochs, the full state of the training is written to a
+    checkpoint next to model_path: the model, args.meta_opt, the inner-loop learning
+    rates, the grad scaler, the best weights and results, the random generators and the
+    arguments. The episodes of an epoch are drawn from these generators, so at an epoch
+    boundary they also hold the position of the samplers. With --resume, the training
+    continues from the checkpoint as if it had not stopped. The checkpoint is deleted
+    once the training is done.
+    """
+    checkpoint_path = os.path.splitext(model_path)[0] + "_checkpoint.pth"
     loss = np.inf
-    for epoch in range(args.n_epochs):
+    best_model = None
+    result = {"model_path": model_path}
+    start_epoch = 0
+    if args.resume and os.path.exists(checkpoint_path):
+        checkpoint = torch.load(
+            checkpoint_path, map_location=args.device, weights_only=False
+        )
+        saved, current = checkpoint["args"], checkpoint_args(args)
+        changed = sorted(
+            k for k in saved.keys() | current.keys() if saved.get(k) != current.get(k)
+        )
+        if changed:
+            raise ValueError(
+                f"{checkpoint_path} was saved with other arguments: "
+                + ", ".join(f"--{k} {saved[k]} (now {current[k]})" for k in changed)
+            )
+        model.load_state_dict(checkpoint["model"])
+        args.meta_opt.load_state_dict(checkpoint["meta_opt"])
+        args.maml.inner_opt.load_state_dict(checkpoint["inner_opt"])
+        args.grad_scaler.load_state_dict(checkpoint["grad_scaler"])
+        start_epoch, loss = checkpoint["epoch"], checkpoint["loss"]
+        best_model, result = checkpoint["best_model"], checkpoint["result"]
+        # the best weights may have been deleted with the model at exit
+        if best_model is not None:
+            torch.save(best_model, model_path)
+        set_rng_state(checkpoint["rng"])
+        printc(f"Resuming at epoch {start_epoch} from {checkpoint_path}")
+
+    for epoch in range(start_epoch, args.n_epochs):
         # args.epoch = epoch  # Update epoch in args
-        train(iter(train_loader), model, epoch, args, run)
-        qry_loss, qry_acc = test(iter(test_loader), model, epoch, args, run)
+        train(get_episodes(train_loader, args), model, epoch, args, run)
+        qry_loss, qry_acc = test(get_episodes(test_loader, args), model, epoch, args, run)
         if qry_loss < loss:
             loss = qry_loss
-            torch.save(model.state_dict(), model_path)
+            best_model = copy.deepcopy(model_state(model, args))
+            torch.save(best_model, model_path)
+            result["metrics"] = plain_metrics(qry_acc)
+        if args.checkpoint_interval > 0 and (epoch + 1) % args.checkpoint_interval == 0:
+            save_checkpoint(
+                {
+                    "epoch": epoch + 1,
+                    "model": model.state_dict(),
+                    "meta_opt": args.meta_opt.state_dict(),
+                    "inner_opt": args.maml.inner_opt.state_dict(),
+                    "grad_scaler": args.grad_scaler.state_dict(),
+                    "loss": loss,
+                    "best_model": best_model,
+                    "result": result,
+                    "rng": get_rng_state(),
+                    "args": checkpoint_args(args),
+                },
+                checkpoint_path,
+            )
+    # a finished training is not resumed
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return result
+
+def model_state(model, args):
+    """
+    What is saved to the model path: the state dict of the model, together with the
+    inner-loop learning rates it was meta-trained with under --learn_inner_lr.
+    """
+    if not args.learn_inner_lr:
+        return model.state_dict()
+    return {"model": model.state_dict(), "inner_opt": args.maml.inner_opt.state_dict()}
+
+def load_model(model, args, model_path):
+    # loads a model saved by fit, and its inner-loop learning rates into args.maml
+    state = torch.load(model_path, map_location=args.device)
+    if "inner_opt" in state:
+        args.maml.inner_opt.load_state_dict(state["inner_opt"])
+        state = state["model"]
+    elif args.learn_inner_lr:
+        raise ValueError(
+            f"{model_path} has no learned inner-loop learning rates, it was not "
+            "trained with --learn_inner_lr"
+        )
+    model.load_state_dict(state)
+
+def plain_metrics(res_dict):
+    # test results as floats, to send between processes and tabulate
+    return {k: float(v) for k, v in res_dict.items() if k != "test/time"}
+
+def run_fold(args, test_subject, datasets=None):
+    """
+    Trains and tests the LOOCV fold holding out test_subject, on the (train, test)
+    datasets of the fold if given. Returns the test results of its epoch with the lowest
+    query loss, as plain floats so they can be sent between processes.
+    """
+    # Initialize datasets with the current subject as test
+    train_dataset, test_dataset = datasets or get_dataset(args, test_subject)
+    seed(args.seed)
+    # Initialize DataLoader
+    train_loader = get_task_loader(train_dataset, args)
+    test_loader = get_task_loader(test_dataset, args)
+    capture_test_dataset_samples(args, test_dataset, test_loader)
+    # Define the model architecture
+    model = get_model(args)
+    model.to(args.device)
+
+    print(
+        "trainable parameters: ",
+        sum(p.numel() for p in model.parameters() if p.requires_grad),
+    )
+
+    # Initialize meta optimizer, with the learned inner-loop learning rates if any
+    args.maml = get_maml(model, args)
+    args.meta_opt = torch.optim.Adam(
+        [*model.parameters(), *args.maml.parameters()], lr=args.lr
+    )
+    args.grad_scaler = get_grad_scaler(args)
+
+    # Run a unique wandb session for each test subject
+    if not args.nowandb:
+        run = wandb.init(
+            project=args.wandb_project,
+            config=vars(args),
+            name=f"{args.model}-{args.dataset}-{args.seed}-subject-{test_dataset.test_subject_filename()}",
+        )
+        model_path = f"saved_model/{run.name}.pth"
+    else:
+        run = None
+        model_path = f"saved_model/{args.model}-{args.dataset}-{args.seed}-subject-{test_dataset.test_subject_filename()}.pth"
+
+    model_exception_handler(model_path)
+
+    # Training loop
+    result = fit(model, train_loader, test_loader, args, run, model_path)
+    result["subject"] = test_dataset.test_subject_filename()
+
+    # Save the model to wandb for each run
     if not args.nowandb:
         log_model_artifact(run, model_path)
         run.finish()
-    return
+    return result
+
+def _init_fold_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+def _run_fold(job):
+    return run_fold(*job)
 
 def main_loocv(args):
-    # Set up for each subject as a separate LOOCV iteration
+    """
+    Runs a fold per subject group of get_all_subjects, one after the other or, with
+    --loocv_workers, in that many processes at once, each limited to --loocv_threads
+    threads. Prints the best test results of every fold and their mean over the folds.
+    """
     all_subjects = get_all_subjects(args)  # Define a function to get all subject IDs
 
-    for test_subject in all_subjects: # Iterate over first 10 subjects
-        # Initialize datasets with the current subject as test
-        train_dataset, test_dataset = get_dataset(args, test_subject)
-        seed(args.seed)
-        
-        # Initialize samplers
-        train_sampler = DenseLabelTaskSampler(
-            train_dataset,
-            n_shot=args.n_shot,
-            batch_size=args.batch_size,
-            n_query=args.n_query,
-            n_tasks=args.n_tasks,
-            threshold_ratio=args.threshold_ratio,
-            add_side_noise=args.add_side_noise,
-            args=args
-        )
-        test_sampler = DenseLabelTaskSampler(
-            test_dataset,
-            n_shot=args.n_shot,
-            batch_size=args.batch_size,
-            n_query=args.n_query,
-            n_tasks=args.n_tasks,
-            threshold_ratio=args.threshold_ratio,
-            add_side_noise=args.add_side_noise,
-            args=args
-        )
-
-        # Initialize DataLoader
-        train_loader = DataLoader(
-            train_dataset,
-            batch_sampler=train_sampler,
-            num_workers=args.num_workers,
-            pin_memory=args.pin_memory,
-            collate_fn=train_sampler.episodic_collate_fn,
-        )
-        test_loader = DataLoader(
-            test_dataset,
-            batch_sampler=test_sampler,
-            num_workers=args.num_workers,
-            pin_memory=args.pin_memory,
-            collate_fn=test_sampler.episodic_collate_fn,
-        )
-        capture_test_dataset_samples(args, test_dataset, test_loader)
-        # Define the model architecture
-        model = get_model(args)
-        model.to(args.device)
-
-        print(
-            "trainable parameters: ",
-            sum(p.numel() for p in model.parameters() if p.requires_grad),
+    if args.loocv_workers <= 1:
+        if args.loocv_threads > 0:
+            torch.set_num_threads(args.loocv_threads)
+        results = [run_fold(args, test_subject) for test_subject in all_subjects]
+    else:
+        num_threads = args.loocv_threads or max(
+            1, (os.cpu_count() or 1) // args.loocv_workers
         )
-
-        # Initialize meta optimizer
-        args.meta_opt = torch.optim.Adam(model.parameters(), lr=args.lr)
-
-        # Run a unique wandb session for each test subject
-        if not args.nowandb:
-            run = wandb.init(
-                project=args.wandb_project,
-                config=vars(args),
-                name=f"{args.model}-{args.dataset}-{args.seed}-subject-{test_dataset.test_subject_filename()}",
-            )
-            model_path = f"saved_model/{run.name}.pth"
-        else:
-            run = None
-            model_path = f"saved_model/{args.model}_subject_{test_dataset.test_subject_filename()}.pth"
-        
-        model_exception_handler(model_path)
-
-        # Training loop
-        loss = np.inf
-        for epoch in range(args.n_epochs):
-            train(iter(train_loader), model, epoch, args, run)
-            qry_loss, qry_acc = test(iter(test_loader), model, epoch, args, run)
-            if qry_loss < loss:
-                loss = qry_loss
-                torch.save(model.state_dict(), model_path)
-        
-        # Save the model to wandb for each run
-        if not args.nowandb:
-            log_model_artifact(run, model_path)
-            run.finish()
-        
-    return
+        # a fresh spawned process per fold: forking after torch started its thread pools,
+        # or CUDA, is not safe
+        with ProcessPoolExecutor(
+            max_workers=args.loocv_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_fold_worker,
+            initargs=(num_threads,),
+            max_tasks_per_child=1,
+        ) as executor:
+            jobs = [(args, test_subject) for test_subject in all_subjects]
+            results = list(executor.map(_run_fold, jobs))
+        # the models are kept or deleted at exit as with the folds run in this process
+        for result in results:
+            model_exception_handler(result["model_path"])
+
+    print_loocv_results(results)
+    return results
+
+def print_loocv_results(results):
+    # best test metrics of every fold, then their mean and standard deviation, a fold
+    # without any finite test loss counts as nan
+    names = next((list(r["metrics"]) for r in results if "metrics" in r), [])
+    for result in results:
+        metrics = result.get("metrics", {})
+        scores = ", ".join(f"{k}: {metrics.get(k, np.nan):.4f}" for k in names)
+        print(f"[LOOCV {result['subject']}] {scores}")
+    for k in names:
+        values = np.array([r.get("metrics", {}).get(k, np.nan) for r in results])
+        print(f"[LOOCV mean] {k}: {np.nanmean(values):.4f} +/- {np.nanstd(values):.4f}")
 
 def log_model_artifact(run, model_path):
     artifact = wandb.Artifact(f"{run.name}", type="model")
@@ -361,28 +555,32 @@ def capture_test_dataset_samples(args, test_dataset, test_loader):
     torch.save(sample_data_in_test, os.path.join(args.data_root, args.dataset, f"{args.dataset}_{str(args.loocv)}_{args.seed}.pt"))
     # printc("Saved 10 samples of data for visualization")
 
-def log_visualization(epoch, wandb_r, net, fnet, inner_opt, args):
+def log_visualization(epoch, wandb_r, net, inner_opt, args):
     # load 10 samples of data for visualization
     sample_data_in_test = torch.load(os.path.join(args.data_root, args.dataset, f"{args.dataset}_{str(args.loocv)}_{args.seed}.pt"))
     for image_idx, (x_spt, y_spt, x_qry, y_qry) in enumerate(sample_data_in_test):
         # visualize the softmax output of the model
         x_spt, y_spt = x_spt.to(args.device), y_spt.to(args.device)
         x_qry, y_qry = x_qry.to(args.device), y_qry.to(args.device)
-        with higher.innerloop_ctx(
-                net, inner_opt, track_higher_grads=False
-            ) as (fnet, diffopt):
-                # Inner-loop adaptation
-                for _ in range(args.n_inner_iter):
-                    spt_logits = fnet(x_spt[:, 0])
-                    spt_loss = F.cross_entropy(spt_logits, y_spt[:, 0].long())
-                    if args.fomaml:
-                        diffopt.step(spt_loss, grad_callback=lambda grads: [g.detach() if g is not None else None for g in grads])
-                    else:
-                        diffopt.step(spt_loss)
         images = x_qry[:, 0]
-        qry_logits = fnet(images).detach()
+        if args.meta_engine == "functional":
+            with get_autocast(args):
+                qry_logits = args.maml.evaluate(x_spt[:, 0], y_spt[:, 0], images)
+        else:
+            with higher.innerloop_ctx(
+                    net, inner_opt, track_higher_grads=False
+                ) as (fnet, diffopt):
+                    # Inner-loop adaptation
+                    for _ in range(args.n_inner_iter):
+                        spt_logits = fnet(x_spt[:, 0])
+                        spt_loss = F.cross_entropy(spt_logits, y_spt[:, 0].long())
+                        if args.fomaml:
+                            diffopt.step(spt_loss, grad_callback=lambda grads: [g.detach() if g is not None else None for g in grads])
+                        else:
+                            diffopt.step(spt_loss)
+            qry_logits = fnet(images).detach()
         labels = y_qry[:, 0]
-        softmaxed = F.softmax(qry_logits, dim=1)
+        softmaxed = F.softmax(upcast(qry_logits), dim=1)
         fsl_visualize_softmax(
             softmaxed[0].cpu().detach().numpy(),
             labels[0].cpu().detach().numpy(),
@@ -40,18 +40,17 @@ class MultiHeadSelfAttention1D(nn.Module):
         self.embed_dim = embed_dim
         self.num_heads = num_heads
         self.self_attn = nn.MultiheadAttention(embed_dim, num_heads)
-        self.pos_embed = None
 
     def forward(self, x):
         batch_size, channels, seq_length = x.size()
-        if self.pos_embed is None or self.pos_embed.size(0) != seq_length:
-            # Initialize positional encoding
-            self.pos_embed = self.create_positional_encoding(
-                seq_length, self.embed_dim
-            ).to(x.device)
+        # Positional encoding, not cached on the module: a tensor created under vmap or
+        # torch.compile must not outlive the call
+        pos_embed = self.create_positional_encoding(
+            seq_length, self.embed_dim
+        ).to(x.device)
 
         x = x.permute(2, 0, 1)  # Shape: [S, B, E]
-        x = x + self.pos_embed.unsqueeze(1)
+        x = x + pos_embed.unsqueeze(1)
 
         attn_output, _ = self.self_attn(x, x, x)
         attn_output = attn_output.permute(1, 2, 0)  # Shape: [B, E, S]
@@ -117,36 +116,67 @@ class EX(nn.Module):
 
         self.decoder1 = nn.Conv1d(embed_dim, out_channels, kernel_size=1)
 
-    def forward(self, x):
-        x = x.permute(0, 2, 1)  # [B, in_channels, S]
-     
-        # Encoder
-        e1 = self.encoder1(x)                        # [B, embed_dim, S]
-        e2 = self.encoder2(self.pool(e1))            # [B, embed_dim * 2, S/2]
-        e3 = self.encoder3(self.pool(e2))            # [B, embed_dim * 4, S/4]
-        e4 = self.encoder4(self.pool(e3))            # [B, embed_dim, S/8]
-
-        # Self-Attention in Bottleneck
-        e4 = self.mhsa(e4)                           # [B, embed_dim, S/8]
-
-        # Decoder with Skip Connections
-        d4 = self.upconv4(e4)                        # Upsample
-        d4 = self._crop_and_concat(d4, e3)           # Match size and concat with e3
-        d4 = self.decoder4(d4)                       # [B, embed_dim * 4, S/4]
-
-        d3 = self.upconv3(d4)                        # Upsample
-        d3 = self._crop_and_concat(d3, e2)           # Match size and concat with e2
-        d3 = self.decoder3(d3)                       # [B, embed_dim * 2, S/2]
-
-        d2 = self.upconv2(d3)                        # Upsample
-        d2 = self._crop_and_concat(d2, e1)           # Match size and concat with e1
-        d2 = self.decoder2(d2)                       # [B, embed_dim, S]
+    STAGES = ("encoder", "decoder", "head")
+
+    def stage_modules(self, stage):
+        return {
+            "encoder": [
+                self.encoder1,
+                self.encoder2,
+                self.encoder3,
+                self.encoder4,
+                self.mhsa,
+            ],
+            "decoder": [
+                self.upconv4,
+                self.decoder4,
+                self.upconv3,
+                self.decoder3,
+                self.upconv2,
+                self.decoder2,
+            ],
+            "head": [self.decoder1],
+        }[stage]
+
+    def forward_stage(self, stage, x):
+        if stage == "encoder":
+            x = x.permute(0, 2, 1)  # [B, in_channels, S]
+
+            # Encoder
+            e1 = self.encoder1(x)                        # [B, embed_dim, S]
+            e2 = self.encoder2(self.pool(e1))            # [B, embed_dim * 2, S/2]
+            e3 = self.encoder3(self.pool(e2))            # [B, embed_dim * 4, S/4]
+            e4 = self.encoder4(self.pool(e3))            # [B, embed_dim, S/8]
+
+            # Self-Attention in Bottleneck
+            e4 = self.mhsa(e4)                           # [B, embed_dim, S/8]
+            return e1, e2, e3, e4
+
+        if stage == "decoder":
+            e1, e2, e3, e4 = x
+            # Decoder with Skip Connections
+            d4 = self.upconv4(e4)                        # Upsample
+            d4 = self._crop_and_concat(d4, e3)           # Match size and concat with e3
+            d4 = self.decoder4(d4)                       # [B, embed_dim * 4, S/4]
+
+            d3 = self.upconv3(d4)                        # Upsample
+            d3 = self._crop_and_concat(d3, e2)           # Match size and concat with e2
+            d3 = self.decoder3(d3)                       # [B, embed_dim * 2, S/2]
+
+            d2 = self.upconv2(d3)                        # Upsample
+            d2 = self._crop_and_concat(d2, e1)           # Match size and concat with e1
+            return self.decoder2(d2)                     # [B, embed_dim, S]
 
         # Final output layer
-        d1 = self.decoder1(d2)                       # [B, out_channels, S]
-        d1 = d1.permute(0, 2, 1)                     # [B, S, out_channels]
+        d1 = self.decoder1(x)                            # [B, out_channels, S]
+        d1 = d1.permute(0, 2, 1)                         # [B, S, out_channels]
         return d1
 
+    def forward(self, x):
+        for stage in self.STAGES:
+            x = self.forward_stage(stage, x)
+        return x
+
     def _crop_and_concat(self, upsampled, bypass):
         # Crop or pad the upsampled tensor to match the size of the bypass tensor
         diff = upsampled.size(-1) - bypass.size(-1)
@@ -41,16 +41,34 @@ class CNN(nn.Module):
         # Final convolutional layer to produce predictions for each timestep
         self.final_conv = nn.Conv1d(conv_sizes[-1], out_channels, kernel_size=1)
 
-    def forward(self, x):
-        # Permute for (batch_size, channels, sequence_length)
-        x = x.permute(0, 2, 1)
-        h = self.conv_net(x)  # Pass through convolutional layers
-        
-        # Upsample to match the original sequence length if needed
-        h = F.interpolate(h, size=x.size(2), mode='linear', align_corners=False)
-        
+    # the upsampling "decoder" has no parameters
+    STAGES = ("encoder", "decoder", "head")
+
+    def stage_modules(self, stage):
+        return {
+            "encoder": [self.conv_net],
+            "decoder": [],
+            "head": [self.final_conv],
+        }[stage]
+
+    def forward_stage(self, stage, x):
+        if stage == "encoder":
+            # Permute for (batch_size, channels, sequence_length)
+            x = x.permute(0, 2, 1)
+            h = self.conv_net(x)  # Pass through convolutional layers
+            return h, x.size(2)
+        if stage == "decoder":
+            h, length = x
+            # Upsample to match the original sequence length if needed
+            return F.interpolate(h, size=length, mode='linear', align_corners=False)
+
         # Apply the final convolution to get output of shape (batch_size, out_channels, window_size)
-        h = self.final_conv(h)
+        h = self.final_conv(x)
 
         # Permute to (batch_size, window_size, out_channels) as required
         return h.permute(0, 2, 1)
+
+    def forward(self, x):
+        for stage in self.STAGES:
+            x = self.forward_stage(stage, x)
+        return x
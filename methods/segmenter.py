@@ -72,21 +72,39 @@ class Segmenter(nn.Module):
                 if param.dim() > 1:
                     nn.init.xavier_uniform_(param)
 
-    def forward(self, inputs):
-        x = inputs.permute(0, 2, 1) # b h c
-        b, c, h = x.shape
-        x = x.view(b, c, -1).permute(0, 2, 1)
-        x = self.dec_proj(x)
-        cls_emb = self.cls_emb.expand(x.size(0), -1, -1)
-        x = torch.cat((x, cls_emb), 1)
-        with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False):
-            for layer in self.layers: 
-                # layer norm:
+    # the "decoder" is the last transformer layer with the decoder norm, the layer
+    # norm shared by all layers stays with the encoder
+    STAGES = ("encoder", "decoder", "head")
+
+    def stage_modules(self, stage):
+        return {
+            "encoder": [self.dec_proj, self.att_norm, *list(self.layers)[:-1]],
+            "decoder": [self.layers[-1], self.decoder_norm],
+            "head": [self.patch_proj, self.classes_proj, self.mask_norm],
+        }[stage]
+
+    def forward_stage(self, stage, x):
+        if stage == "encoder":
+            x = x.permute(0, 2, 1) # b h c
+            b, c, h = x.shape
+            x = x.view(b, c, -1).permute(0, 2, 1)
+            x = self.dec_proj(x)
+            cls_emb = self.cls_emb.expand(x.size(0), -1, -1)
+            x = torch.cat((x, cls_emb), 1)
+            with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False):
+                for layer in list(self.layers)[:-1]:
+                    # layer norm:
+                    x = self.att_norm(x)
+
+                    x = layer(x)
+            return x
+        if stage == "decoder":
+            with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False):
                 x = self.att_norm(x)
-                
-                x = layer(x)
-        x = self.decoder_norm(x)
+                x = self.layers[-1](x)
+            return self.decoder_norm(x)
 
+        b, h = x.size(0), x.size(1) - self.num_classes
         patches = self.patch_proj(x[:, :-self.num_classes]) # shape 128, 75, 64 (B, Time_length, embedding)
         cls_seg_feat = self.classes_proj(x[:, -self.num_classes:]) # shape 128, 7, 64 (B, num_classes, embedding)
         # cls_seg_feat = nn.functional.dropout(cls_seg_feat, p=0.5, training=self.training)
@@ -96,6 +114,12 @@ class Segmenter(nn.Module):
         masks = self.mask_norm(masks).contiguous().view(b, h, -1)
 
         return masks
+
+    def forward(self, inputs):
+        x = inputs
+        for stage in self.STAGES:
+            x = self.forward_stage(stage, x)
+        return x
     def get_embedding(self, inputs):
         x = inputs
         x = self.dec_proj(x)
@@ -59,14 +59,38 @@ class TransformerModel(nn.Module):
                 nn.init.xavier_uniform_(param)
         
                     
-    def forward(self, src):
-        src = self.input_emb(src)
-        src = self.relu(src)
-        with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False):
-            output = self.transformer_encoder(src)
+    # the "decoder" is the last encoder layer with the final norm
+    STAGES = ("encoder", "decoder", "head")
 
-        output = self.decoder(output)
+    def stage_modules(self, stage):
+        layers = self.transformer_encoder.layers
+        return {
+            "encoder": [self.input_emb, *list(layers)[:-1]],
+            "decoder": [layers[-1], self.transformer_encoder.norm],
+            "head": [self.decoder],
+        }[stage]
+
+    def forward_stage(self, stage, src):
+        layers = self.transformer_encoder.layers
+        if stage == "encoder":
+            src = self.input_emb(src)
+            src = self.relu(src)
+            with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False):
+                for layer in list(layers)[:-1]:
+                    src = layer(src)
+            return src
+        if stage == "decoder":
+            with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False):
+                output = layers[-1](src)
+            return self.transformer_encoder.norm(output)
+
+        output = self.decoder(src)
         return output
+
+    def forward(self, src):
+        for stage in self.STAGES:
+            src = self.forward_stage(stage, src)
+        return src
     
     def forward_pred(self, inputs):
         masks = self.forward(inputs)
@@ -58,19 +58,37 @@ class UNet(nn.Module):
         self.up2 = UpConv(64, 32)
         self.final_conv = nn.Conv1d(32, out_channels, kernel_size=1)
 
-    def forward(self, x):
-        x = x.permute(0, 2, 1)
-        x1 = self.conv1(x)
-        p1 = self.pool1(x1)
-        x2 = self.conv2(p1)
-        p2 = self.pool2(x2)
-        x3 = self.conv3(p2)
-        x = self.up1(x3, x2)
-        x = self.up2(x, x1)
+    STAGES = ("encoder", "decoder", "head")
+
+    def stage_modules(self, stage):
+        return {
+            "encoder": [self.conv1, self.conv2, self.conv3],
+            "decoder": [self.up1, self.up2],
+            "head": [self.final_conv],
+        }[stage]
+
+    def forward_stage(self, stage, x):
+        if stage == "encoder":
+            x = x.permute(0, 2, 1)
+            x1 = self.conv1(x)
+            p1 = self.pool1(x1)
+            x2 = self.conv2(p1)
+            p2 = self.pool2(x2)
+            x3 = self.conv3(p2)
+            return x1, x2, x3
+        if stage == "decoder":
+            x1, x2, x3 = x
+            x = self.up1(x3, x2)
+            return self.up2(x, x1)
         x = self.final_conv(x)
         x = x.permute(0, 2, 1)
         return x
 
+    def forward(self, x):
+        for stage in self.STAGES:
+            x = self.forward_stage(stage, x)
+        return x
+
     def forward_pred(self, x):
         masks = self.forward(x)
         masks = masks.permute(0, 2, 1)
@@ -5,13 +5,7 @@ datasets=("physiq" "mmfit" "spar")
 # unet and ex not here:
 models=( "transformer" "segmenter" "cnn")
 
-for dataset in "${datasets[@]}"; do
-  for model in "${models[@]}"; do
-    if [[ "$dataset" == "spar" || "$dataset" == "mmfit" ]]; then
-      window_size=300
-    else
-      window_size=500
-    fi
-    python main_meta_v2.py --add_side_noise --dataset "$dataset" --model "$model" --loocv --window_step 5 --window_size "$window_size" --n_shot 1 --n_query 1 --n_epochs 200 
-  done
-done
\ No newline at end of file
+# Every (dataset, fold, model) trial, one after the other as sweep.py --sweep_workers 1
+python sweep.py --datasets "${datasets[@]}" --models "${models[@]}" --seeds 42 \
+  --window_sizes physiq=500 mmfit=300 spar=300 --sweep_workers 1 --results sweep_loocv.csv \
+  --add_side_noise --loocv --window_step 5 --n_shot 1 --n_query 1 --n_epochs 200
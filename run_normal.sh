@@ -5,20 +5,7 @@ models=("transformer" "unet" "cnn" "ex" "segmenter")
 # Set a maximum number of parallel jobs
 max_jobs=4  # Adjust based on your system's capacity
 
-# Loop over seeds, datasets, and models
-for seed in {42..46}; do
-  for dataset in "${datasets[@]}"; do
-    for model in "${models[@]}"; do
-      # Run the command in the background
-      python main_meta_v2.py --add_side_noise --dataset "$dataset" --model "$model" --seed "$seed" --n_epochs 200 &
-
-      # Limit the number of parallel jobs
-      if [[ $(jobs -r -p | wc -l) -ge $max_jobs ]]; then
-        wait -n  # Wait for any job to finish before starting a new one
-      fi
-    done
-  done
-done
-
-# Wait for all background jobs to complete
-wait
+# Every (seed, dataset, model) trial, scheduled by sweep.py on max_jobs worker processes
+python sweep.py --datasets "${datasets[@]}" --models "${models[@]}" --seeds {42..46} \
+  --sweep_workers "$max_jobs" --results sweep_normal.csv \
+  --add_side_noise --n_epochs 200
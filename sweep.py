@@ -0,0 +1,166 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+import torch
+
+import main_meta_v2
+from until_argparser import get_all_subjects, get_args, get_dataset
+from utilities import model_exception_handler, seed
+
+
+def get_sweep_args():
+    parser = argparse.ArgumentParser(
+        description="Sweep of main_meta_v2.py trials over datasets, models and seeds. "
+        "Other arguments are passed to every trial.",
+        # --window_size is an argument of the trials, not an abbreviation of --window_sizes
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--datasets", type=str, nargs="+", default=["mmfit", "physiq", "spar"]
+    )
+    parser.add_argument(
+        "--models",
+        type=str,
+        nargs="+",
+        default=["transformer", "unet", "cnn", "ex", "segmenter"],
+    )
+    parser.add_argument("--seeds", type=int, nargs="+", default=[42, 43, 44, 45, 46])
+    parser.add_argument(
+        "--window_sizes",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Window size of the trials of a dataset, as dataset=size (e.g. mmfit=300)",
+    )
+    parser.add_argument(
+        "--sweep_workers",
+        type=int,
+        default=4,
+        help="Number of trials run at once, each in a worker process",
+    )
+    parser.add_argument(
+        "--sweep_threads",
+        type=int,
+        default=0,
+        help="torch threads per worker, 0 to share the CPUs between the workers",
+    )
+    parser.add_argument(
+        "--results",
+        type=str,
+        default="sweep_results.csv",
+        help="CSV file of the best test results of every trial",
+    )
+    return parser.parse_known_args()
+
+
+def _init_trial_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _run_trial(argv, test_subject, datasets):
+    # runs in a worker process, which is reused by the following trials
+    args = get_args(argv)
+    if args.compile:
+        # the graphs of the previous trial belong to another model
+        torch._dynamo.reset()
+    start_time = time.time()
+    if args.loocv:
+        result = main_meta_v2.run_fold(args, test_subject, datasets)
+    else:
+        result = main_meta_v2.main(args, datasets)
+    result["time"] = time.time() - start_time
+    return result
+
+
+def data_configs(sweep_args, base_argv):
+    """
+    Arguments of the datasets of the sweep, the part of the arguments of a trial that
+    its datasets depend on.
+    """
+    window_sizes = dict(item.split("=") for item in sweep_args.window_sizes)
+    for dataset in sweep_args.datasets:
+        data_argv = ["--dataset", dataset]
+        if dataset in window_sizes:
+            data_argv += ["--window_size", window_sizes[dataset]]
+        yield dataset, base_argv + data_argv
+
+
+def capture_samples(args, test_dataset, seeds):
+    # the visualization samples of every seed, written once before the trials that
+    # would all write them at once, drawn as by main_meta_v2.main
+    for trial_seed in seeds:
+        args.seed = trial_seed
+        seed(args.seed)
+        test_loader = main_meta_v2.get_task_loader(test_dataset, args)
+        main_meta_v2.capture_test_dataset_samples(args, test_dataset, test_loader)
+
+
+def main(sweep_args, base_argv):
+    """
+    Runs a trial per (dataset, model, seed), and per LOOCV fold with --loocv, on a pool of
+    --sweep_workers processes. The datasets of every dataset (and fold) are built once,
+    here, and shared by all its trials: their windows are memory-mapped, so the workers
+    receive the path of the window store instead of a copy. Every finished trial is added
+    to the --results table.
+    """
+    num_threads = sweep_args.sweep_threads or max(
+        1, (os.cpu_count() or 1) // sweep_args.sweep_workers
+    )
+    futures = {}
+    rows = []
+    with ProcessPoolExecutor(
+        max_workers=sweep_args.sweep_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_trial_worker,
+        initargs=(num_threads,),
+    ) as executor:
+        # the datasets of the next dataset are built while the trials of the previous run
+        for dataset, data_argv in data_configs(sweep_args, base_argv):
+            args = get_args(data_argv)
+            test_subjects = get_all_subjects(args) if args.loocv else [None]
+            for test_subject in test_subjects:
+                datasets = get_dataset(args, test_subject)
+                subject = datasets[1].test_subject_filename() if args.loocv else None
+                capture_samples(args, datasets[1], sweep_args.seeds)
+                for model in sweep_args.models:
+                    for trial_seed in sweep_args.seeds:
+                        argv = data_argv + ["--model", model, "--seed", str(trial_seed)]
+                        future = executor.submit(
+                            _run_trial, argv, test_subject, datasets
+                        )
+                        futures[future] = {
+                            "dataset": dataset,
+                            "model": model,
+                            "seed": trial_seed,
+                            "subject": subject,
+                        }
+
+        for future in as_completed(futures):
+            row = dict(futures[future])
+            try:
+                result = future.result()
+            except Exception as e:
+                # a failed trial is reported in the table, the others go on
+                row["error"] = repr(e)
+            else:
+                # the models are kept or deleted at exit as with a trial run on its own
+                model_exception_handler(result["model_path"])
+                row.update(result.get("metrics", {}), time=result["time"])
+            rows.append(row)
+            pd.DataFrame(rows).to_csv(sweep_args.results, index=False)
+            print(f"[Sweep {len(rows)}/{len(futures)}] {row}")
+
+    # mean over the seeds (and folds) of every dataset and model
+    results = pd.DataFrame(rows)
+    summary = results.drop(columns="seed").groupby(["dataset", "model"])
+    print(summary.mean(numeric_only=True).to_string())
+    return results
+
+
+if __name__ == "__main__":
+    sweep_args, base_argv = get_sweep_args()
+    main(sweep_args, base_argv)
@@ -18,7 +18,13 @@ from datasets.DenseLabelTaskSampler import DenseLabelTaskSampler
 from MetricsAccumulator import MetricsAccumulator
 from main_meta_v2 import capture_test_dataset_samples
 from methods import EX, UNet
-from until_argparser import get_all_subjects, get_args, get_dataset, get_model
+from until_argparser import (
+    get_all_subjects,
+    get_args,
+    get_dataset,
+    get_maml,
+    get_model,
+)
 from utilities import model_exception_handler, printc, seed
 from utils_metrics import fsl_visualize_softmax, visualize_softmax
 import main_meta_v2
@@ -56,18 +62,19 @@ def main_test_only(args):
     model.to(args.device)  # Move model to specified device
 
     # Initialize meta optimizer
+    args.maml = get_maml(model, args)
     args.meta_opt = torch.optim.Adam(model.parameters(), lr=args.lr)
     run = None
     model_path = f"saved_model/wandb_artifacts/{args.model}_{args.dataset}/{args.model}-{args.dataset}-{args.seed}.pth"
     # model_exception_handler(model_path)
-    model.load_state_dict(torch.load(model_path, map_location=args.device))
+    main_meta_v2.load_model(model, args, model_path)
     epoch = 200
     # if model_path exists:
     if not os.path.exists(model_path):
         print(f"Model path {model_path} does not exist.")
         return
     qry_loss, qry_acc = main_meta_v2.test(
-        iter(test_loader), model, epoch, args, run
+        main_meta_v2.get_episodes(test_loader, args), model, epoch, args, run
     )
 
     # print(f"Test Loss: {qry_loss:.4f}, qry_acc: {qry_acc}")
@@ -1,11 +1,13 @@
 import argparse
 
+import torch
 import torch.nn as nn
 
+from FunctionalMAML import FunctionalMAML
 from datasets.MMFIT import MMFIT
 from datasets.PhysiQ import PhysiQ
 from datasets.SPAR import SPAR
-from datasets.Transforms import IMUAugmentation
+from datasets.Transforms import BatchIMUAugmentation, IMUAugmentation
 from methods.cnn import CNN
 from methods.EX import EX
 from methods.segmenter import Segmenter
@@ -14,18 +16,20 @@ from methods.unet import UNet
 from utilities import seed
 
 
+# models by --model name
+MODELS = {
+    "unet": UNet,
+    "transformer": TransformerModel,
+    "ex": EX,
+    "segmenter": Segmenter,
+    "cnn": CNN,
+}
+
+
 def get_model_args(args, preliminary_args):
     model = preliminary_args.model.lower()
-    if model == "unet":
-        args = UNet.add_args(args)
-    elif model == "transformer":
-        args = TransformerModel.add_args(args)
-    elif model == "ex":
-        args = EX.add_args(args)
-    elif model == "segmenter":
-        args = Segmenter.add_args(args)
-    elif model == "cnn":
-        args = CNN.add_args(args)
+    if model in MODELS:
+        args = MODELS[model].add_args(args)
     return args
 
 
@@ -37,39 +41,126 @@ def get_dataset_args(args, preliminary_args):
     return args
 
 
-def get_model(args):
-    args.model = args.model.lower()
-    if args.model == "unet":
-        model = UNet
-    elif args.model == "transformer":
-        model = TransformerModel
-    elif args.model == "ex":
-        model = EX
-    elif args.model == "segmenter":
-        model = Segmenter
-    elif args.model == "cnn":
-        model = CNN
-    else:
-        raise ValueError("Model not supported")
+class ModelWrapper(nn.Module):
+    """
+    Wraps a network of MODELS to output (batch, window_size) logits or (batch, classes,
+    window_size) logits, and runs slices of its stages for the inner loop. Defined at module
+    level, so that torch.compile traces it as any other module.
 
-    class model_wrapper(nn.Module):
-        def __init__(self):
-            super(model_wrapper, self).__init__()
-            self.net = model(args)
+    The forward of a network is split into stages: its STAGES names them in order,
+    stage_modules(stage) lists the modules holding the parameters of a stage, and
+    forward_stage(stage, x) runs one stage on the output of the previous one. FunctionalMAML
+    adapts the stages from the chosen --adapt_scope on, and runs the earlier ones once per
+    task.
+    """
 
-        def forward(self, x):
+    def __init__(self, model, args):
+        super(ModelWrapper, self).__init__()
+        self.net = model(args)
+
+    def forward(self, x, stages=None):
+        if stages is not None:
+            return self.forward_stages(x, stages)
+        x = x.float()
+        x = self.net(x)
+        x = x.permute(0, 2, 1)
+        return x.squeeze(1)
+
+    def forward_stages(self, x, stages):
+        # runs a slice of the stages of the model
+        if not stages.start:
             x = x.float()
-            x = self.net(x)
+        for stage in self.net.STAGES[stages]:
+            x = self.net.forward_stage(stage, x)
+        if stages.stop is None:
             x = x.permute(0, 2, 1)
-            return x.squeeze(1)
+            x = x.squeeze(1)
+        return x
+
+    @property
+    def STAGES(self):
+        return self.net.STAGES
+
+    def frozen_stages(self, adapted):
+        # number of leading stages without any of the adapted parameters
+        for start in range(len(self.net.STAGES) - 1, 0, -1):
+            if set(adapted) <= set(self.stage_parameter_names(start)):
+                return start
+        return 0
+
+    def stage_parameter_names(self, start):
+        # names of the parameters of the stages from start on
+        stage_params = {
+            id(p)
+            for stage in self.net.STAGES[start:]
+            for module in self.net.stage_modules(stage)
+            for p in module.parameters()
+        }
+        return [k for k, p in self.named_parameters() if id(p) in stage_params]
+
+
+def get_model(args):
+    args.model = args.model.lower()
+    if args.model not in MODELS:
+        raise ValueError("Model not supported")
 
     # Initialize model
-    model = model_wrapper().float()
+    model = ModelWrapper(MODELS[args.model], args).float()
     return model
 
 
+def get_batch_augmentation(args):
+    # with --batch_augmentation, the train tasks are augmented on the device after collation
+    if not args.batch_augmentation:
+        return None
+    return BatchIMUAugmentation(rotation_chance=args.rotation_chance)
+
+
+# autocast dtype of each --precision, fp32 runs without autocast
+AUTOCAST_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": None}
+
+
+def get_autocast(args):
+    # a fresh autocast context for the forward passes of --precision
+    dtype = AUTOCAST_DTYPES[args.precision]
+    return torch.autocast(
+        torch.device(args.device).type, dtype=dtype, enabled=dtype is not None
+    )
+
+
+def get_grad_scaler(args):
+    # fp16 gradients need loss scaling, bf16 has the exponent range of fp32
+    return torch.amp.GradScaler(
+        torch.device(args.device).type, enabled=args.precision == "fp16"
+    )
+
+
+def get_maml(model, args):
+    # the inner-loop engine of a model, built once so its buffers are reused across epochs
+    if args.adapt_scope != "all" and args.meta_engine != "functional":
+        raise ValueError("--adapt_scope requires the functional --meta_engine")
+    if args.precision == "fp16" and args.meta_engine != "functional":
+        raise ValueError("--precision fp16 requires the functional --meta_engine")
+    if args.compile and args.meta_engine != "functional":
+        raise ValueError("--compile requires the functional --meta_engine")
+    return FunctionalMAML(
+        model,
+        args.meta_lr,
+        args.n_inner_iter,
+        first_order=args.fomaml,
+        learn_lr=args.learn_inner_lr,
+        adapt_scope=args.adapt_scope,
+        loss_scale=2.0**12 if args.precision == "fp16" else 1.0,
+        compile=args.compile,
+    )
+
+
 def get_dataset(args, test_subject=None):
     dataset = args.dataset.lower()
+    if args.batch_augmentation:
+        train_transforms = None
+    else:
+        train_transforms = IMUAugmentation(rotation_chance=args.rotation_chance)
     if dataset == "physiq":
         train_dataset = PhysiQ(
             root=args.data_root,
@@ -78,7 +169,7 @@ def get_dataset(args, test_subject=None):
             window_step=args.window_step,
             bg_fg=None,
             args=args,
-            transforms=IMUAugmentation(rotation_chance=args.rotation_chance),
+            transforms=train_transforms,
             test_subject=test_subject,
         )
         test_dataset = PhysiQ(
@@ -98,7 +189,7 @@ def get_dataset(args, test_subject=None):
             window_step=args.window_step,
             bg_fg=None,
             args=args,
-            transforms=IMUAugmentation(rotation_chance=args.rotation_chance),
+            transforms=train_transforms,
             test_subject=test_subject,
         )
         test_dataset = SPAR(
@@ -118,7 +209,7 @@ def get_dataset(args, test_subject=None):
             window_step=args.window_step,
             bg_fg=None,
             args=args,
-            transforms=IMUAugmentation(rotation_chance=args.rotation_chance),
+            transforms=train_transforms,
             test_subject=test_subject,
         )
         test_dataset = MMFIT(
@@ -159,7 +250,8 @@ def get_all_subjects(args):
     return all_subjects
 
 
-def get_args():
+def get_args(argv=None):
+    # argv defaults to the command line, sweep.py parses the arguments of every trial
     parser = argparse.ArgumentParser(
         description="Meta-learning for dense labeling tasks"
     )
@@ -264,22 +356,79 @@ def get_args():
         default=0,
         help="Number of workers for DataLoader",
     )
+    parser.add_argument(
+        "--ingest_workers",
+        type=int,
+        default=0,
+        help="Number of worker processes for building the dataset",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream windows from the signal store instead of loading the whole dataset",
+    )
+    parser.add_argument(
+        "--stream_chunk_size",
+        type=int,
+        default=65536,
+        help="Number of rows read at once per recording when streaming",
+    )
+    parser.add_argument(
+        "--stream_buffer_size",
+        type=int,
+        default=1024,
+        help="Number of windows buffered per exercise to sample a task from when streaming",
+    )
     parser.add_argument(
         "--pin_memory",
         action="store_true",
         help="Use pinned memory for DataLoader",
     )
+    parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=2,
+        help="Number of episodes sampled and moved to the device ahead of training, 0 to disable",
+    )
     parser.add_argument(
         "--rotation_chance",
         type=float,
         default=0,
         help="Chance of rotating the data",
     )
+    parser.add_argument(
+        "--batch_augmentation",
+        action="store_true",
+        help="Augment the collated tasks on the device instead of every sample in the DataLoader",
+    )
     parser.add_argument(
         "--loocv",
         action="store_true",
         help="Leave-one-out cross-validation",
     )
+    parser.add_argument(
+        "--loocv_workers",
+        type=int,
+        default=1,
+        help="Number of LOOCV folds run at once, each in its own process",
+    )
+    parser.add_argument(
+        "--loocv_threads",
+        type=int,
+        default=0,
+        help="torch threads per LOOCV fold, 0 to share the CPUs between the --loocv_workers",
+    )
+    parser.add_argument(
+        "--checkpoint_interval",
+        type=int,
+        default=0,
+        help="Number of epochs between full checkpoints of the training, 0 to disable",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the training from its last checkpoint, if any (with --nowandb)",
+    )
     # Training parameters
     parser.add_argument(
         "--lr",
@@ -327,6 +476,37 @@ def get_args():
         "--fomaml",
         action="store_true",
     )
+    parser.add_argument(
+        "--meta_engine",
+        type=str,
+        default="functional",
+        choices=["functional", "higher"],
+        help="MAML engine: torch.func with all tasks adapted in parallel, or higher with one task at a time",
+    )
+    parser.add_argument(
+        "--learn_inner_lr",
+        action="store_true",
+        help="Meta-learn one inner-loop learning rate per parameter tensor (functional engine)",
+    )
+    parser.add_argument(
+        "--adapt_scope",
+        type=str,
+        default="all",
+        choices=["all", "decoder", "head"],
+        help="Layers adapted in the inner loop, the body before them is computed once per task",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="fp32",
+        choices=["fp32", "bf16", "fp16"],
+        help="Autocast precision of the forward passes, fp16 with loss scaling",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the forward of the model with torch.compile (functional engine)",
+    )
     parser.add_argument(
         "-m",
         "--model",
@@ -348,11 +528,15 @@ def get_args():
         "--model", type=str, default="unet", help="Specify the model"
     )
     # Parse known arguments to extract the dataset
-    preliminary_args, _ = preliminary_parser.parse_known_args()
+    preliminary_args, _ = preliminary_parser.parse_known_args(argv)
 
     # Add PhysiQ-specific arguments
     # parser = get_dataset_args(parser, preliminary_args)
     parser = get_model_args(parser, preliminary_args)
     # model = get_model(parser.parse_args())
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.resume and not args.nowandb:
+        # a resumed training would be logged to a new wandb run, without its first epochs
+        parser.error("--resume requires --nowandb")
+    return args
@@ -20,6 +20,11 @@ def seed(sd=0, cudnn=False, deterministic=False):
     torch.use_deterministic_algorithms(deterministic)
 
 
+def upcast(x):
+    # half precision (e.g. outputs under autocast) to fp32, fp32 and fp64 are kept
+    return x.to(torch.promote_types(x.dtype, torch.float32))
+
+
 def get_device():
     """
     Checks for the availability of MPS and CUDA devices and returns the appropriate device.
@@ -58,21 +63,7 @@ class sliding_windows(torch.nn.Module):
         self.step = step
 
     def forward(self, input_time_series, labels):
-        # Calculate number of sliding windows
-        num_windows = self.get_num_sliding_windows(input_time_series.size(-2))
-
-        # Calculate the required total length to fit exact sliding windows
-        required_length = num_windows * self.step + self.width - self.step
-        total_length = input_time_series.size(-2)
-
-        # If needed, pad the input_time_series by repeating the initial segment
-        if total_length < required_length:
-            num_pads = required_length - total_length
-            if num_pads > 0:
-                padding = input_time_series[:num_pads]  # Pad from the beginning
-                input_time_series = torch.cat(
-                    (input_time_series, padding), dim=0
-                )
+        input_time_series = self.pad(input_time_series)
 
         # Create sliding windows for input
         input_transformed = torch.swapaxes(
@@ -83,18 +74,47 @@ class sliding_windows(torch.nn.Module):
 
         # Handle labels similarly
         if labels is not None:
-            total_labels_length = labels.size(0)
-            if total_labels_length < required_length:
-                num_pads = required_length - total_labels_length
-                if num_pads > 0:
-                    padding_labels = labels[:num_pads]
-                    labels = torch.cat((labels, padding_labels), dim=0)
+            labels = self.pad(labels)
             labels_transformed = labels.unfold(0, self.width, self.step)
         else:
             labels_transformed = None
 
         return input_transformed, labels_transformed
 
+    def pad(self, time_series):
+        """
+        Pads a (T, ...) tensor or array by repeating its initial segment, so that the
+        sliding windows fit exactly.
+        """
+        total_length = time_series.shape[0]
+        required_length = self.padded_length(total_length)
+
+        # If needed, pad the time_series by repeating the initial segment
+        if total_length < required_length:
+            padding = time_series[: required_length - total_length]  # Pad from the beginning
+            if isinstance(time_series, torch.Tensor):
+                time_series = torch.cat((time_series, padding), dim=0)
+            else:
+                time_series = np.concatenate((time_series, padding), axis=0)
+        return time_series
+
+    def padded_length(self, total_length):
+        """
+        Length of a series of total_length after pad().
+        """
+        # Calculate number of sliding windows
+        num_windows = self.get_num_sliding_windows(total_length)
+
+        # Calculate the required total length to fit exact sliding windows
+        required_length = num_windows * self.step + self.width - self.step
+        return max(total_length, required_length)
+
+    def window_starts(self, padded_length):
+        """
+        Start index of every window that forward() takes from an already padded series.
+        """
+        return np.arange(0, padded_length - self.width + 1, self.step)
+
     def get_num_sliding_windows(self, total_length):
         return max(
             1, round((total_length - (self.width - self.step)) / self.step)
@@ -213,127 +233,94 @@ import numpy as np
 from scipy.spatial.transform import Rotation as R
 
 
-def generate_patterned_imu_noise(
-    data,
+def rotation_matrices(rotation_vectors):
+    """
+    Batched rotation matrices (..., 3, 3) of rotation vectors (..., 3), by Rodrigues' formula
+    (the same matrices as scipy's Rotation.from_rotvec(...).as_matrix()).
+    """
+    angles = np.linalg.norm(rotation_vectors, axis=-1)
+    axes = rotation_vectors / np.where(angles > 0, angles, 1)[..., None]
+    x, y, z = axes[..., 0], axes[..., 1], axes[..., 2]
+    zero = np.zeros_like(x)
+    cross = np.stack(
+        [
+            np.stack([zero, -z, y], axis=-1),
+            np.stack([z, zero, -x], axis=-1),
+            np.stack([-y, x, zero], axis=-1),
+        ],
+        axis=-2,
+    )
+    angles = angles[..., None, None]
+    return np.eye(3) + np.sin(angles) * cross + (1 - np.cos(angles)) * (cross @ cross)
+
+
+def generate_patterned_imu_noise_batch(
+    references,
+    max_lengths,
     reference_length=5,
-    max_length=25,
     noise_type="static_pause",
     range_percentage=0.05,
     peak_intensity=1.0,
     peak_probability=0.1,
     directional_bias=0.1,
+    rng=np.random,
 ):
-    # Separate accelerometer and gyroscope data from the initial pattern
-    accel_baseline = data[-reference_length:, 0:3]
-    gyro_baseline = data[-reference_length:, 3:6]
-
-    # Calculate the mean and range for static pause fluctuation level
-    accel_mean = accel_baseline.mean(axis=0)
-    gyro_mean = gyro_baseline.mean(axis=0)
-    accel_range = accel_baseline.max(axis=0) - accel_baseline.min(axis=0)
-    gyro_range = gyro_baseline.max(axis=0) - gyro_baseline.min(axis=0)
-
-    # Set fluctuation level based on a percentage of the range
-    fluctuation_level_accel = range_percentage * accel_range
-    fluctuation_level_gyro = range_percentage * gyro_range
-
-    # Number of time steps in the noise segment
-    T = np.random.randint(max_length // 5, max_length)
-
-    # Generate directional trend
-    directional_trend = (
-        directional_bias
-        * np.linspace(0, 1, T).reshape(-1, 1)
-        * np.random.choice([-1, 1], size=(1, 3))
-    )
-
-    # Generate random fluctuations for accelerometer and gyroscope for each time step
-    accel_fluctuations = np.random.uniform(
-        -fluctuation_level_accel, fluctuation_level_accel, (T, 3)
-    )
-    gyro_fluctuations = np.random.uniform(
-        -fluctuation_level_gyro, fluctuation_level_gyro, (T, 3)
-    )
-
-    # Determine peak indices for accelerometer and gyroscope randomly
-    peak_indices = np.random.rand(T) < peak_probability
-    peak_accel = np.random.uniform(-peak_intensity, peak_intensity, (T, 3))
-    peak_gyro = np.random.uniform(-peak_intensity, peak_intensity, (T, 3))
-
-    # Apply peak intensity only at selected indices
-    accel_fluctuations[peak_indices] = peak_accel[peak_indices]
-    gyro_fluctuations[peak_indices] = peak_gyro[peak_indices]
-
-    # Combine trend and fluctuation based on noise type
-    if noise_type == "directional_shift":
-        accel_samples = accel_mean + directional_trend + accel_fluctuations
-        gyro_samples = gyro_mean + directional_trend + gyro_fluctuations
-    else:
-        accel_samples = accel_mean + accel_fluctuations
-        gyro_samples = gyro_mean + gyro_fluctuations
-
-    # Generate random rotation vectors and apply them to the accelerometer data
-    random_axes = np.random.uniform(-1, 1, (T, 3))
-    random_axes /= np.linalg.norm(random_axes, axis=1).reshape(-1, 1)
-    rotation_angles = np.random.uniform(
-        -fluctuation_level_accel.mean(), fluctuation_level_accel.mean(), T
-    )
-    rotation_vectors = random_axes * rotation_angles.reshape(-1, 1)
-    rotations = R.from_rotvec(rotation_vectors)
-    rotated_accel = rotations.apply(accel_samples)
-
-    # Stack accelerometer and gyroscope data to form the IMU noise segment
-    imu_noise_segment = np.hstack([rotated_accel, gyro_samples])
-
-    return imu_noise_segment
-
-
-def static_pause(data, reference_length, noise_shape):
     """
-    Generate static pause noise based on a reference range from the data.
+    Patterned IMU noise segments, each continuing from the end of a reference, generated
+    in one vectorized pass.
 
     Parameters:
-        data (array): Base noise data to extract min and max values.
-        reference_length (int): Number of rows from the end of data to calculate min and max.
-        noise_shape (tuple): Shape of the new noise array.
+        references (list of arrays): Data each segment continues from, shape (variable, 6).
+        max_lengths (array): Segment i has between max_lengths[i] // 5 and max_lengths[i] rows.
+        rng (RandomState): Generator the noise is drawn from, np.random by default.
 
     Returns:
-        array: Generated static pause noise.
+        array: All segments concatenated, shape (total length, 6).
+        array: Offsets of the segments in it, shape (len(references) + 1,).
     """
-    imu_noise_segment = generate_patterned_imu_noise(
-        data,
-        reference_length=reference_length,
-        noise_type="static_pause",
-        max_length=noise_shape[0],
-        range_percentage=0.5,
-        peak_probability=0,
+    max_lengths = np.asarray(max_lengths)
+    num_segments = len(references)
+
+    # Mean and range of the last reference_length rows before every segment
+    baselines = [np.asarray(r)[-reference_length:] for r in references]
+    mean = np.stack([b.mean(axis=0) for b in baselines])
+    value_range = np.stack([b.max(axis=0) - b.min(axis=0) for b in baselines])
+    fluctuation_level = range_percentage * value_range
+
+    # Ragged layout: the segment of each row and its time step within the segment
+    lengths = rng.randint(max_lengths // 5, max_lengths)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    segment = np.repeat(np.arange(num_segments), lengths)
+    step = np.arange(offsets[-1]) - offsets[segment]
+
+    # Directional trend, a linspace(0, 1, T) per segment
+    directional_trend = (
+        directional_bias
+        * (step / np.maximum(lengths - 1, 1)[segment]).reshape(-1, 1)
+        * rng.choice([-1, 1], size=(num_segments, 3))[segment]
     )
 
-    return imu_noise_segment
-
-
-def idle_movement(noise, reference_length, noise_shape):
-    """
-    Generate idle movement noise with more variability and slight directional trends.
+    # Random fluctuations, replaced by peaks at random time steps
+    fluctuations = rng.uniform(
+        -fluctuation_level[segment], fluctuation_level[segment]
+    )
+    peak_indices = rng.rand(len(segment)) < peak_probability
+    peaks = rng.uniform(-peak_intensity, peak_intensity, (len(segment), 6))
+    fluctuations[peak_indices] = peaks[peak_indices]
 
-    Parameters:
-        noise (array): Base noise array to reference recent sensor values.
-        reference_length (int): Number of rows to calculate baseline mean.
-        noise_shape (tuple): Shape of the generated idle movement noise (T, D), where T is time steps, D is the number of IMU axes.
+    samples = mean[segment] + fluctuations
+    if noise_type == "directional_shift":
+        samples += np.hstack([directional_trend, directional_trend])
 
-    Returns:
-        array: Generated idle movement noise segment.
-    """
-    imu_noise_segment = generate_patterned_imu_noise(
-        noise,
-        reference_length=reference_length,
-        noise_type="directional_shift",
-        max_length=noise_shape[0],
-        range_percentage=0.5,
-        peak_probability=0,
-    )
+    # Random rotation of the accelerometer at every time step, as one batched matmul
+    random_axes = rng.uniform(-1, 1, (len(segment), 3))
+    random_axes /= np.linalg.norm(random_axes, axis=1).reshape(-1, 1)
+    accel_level = fluctuation_level[:, :3].mean(axis=1)[segment]
+    rotation_angles = rng.uniform(-accel_level, accel_level)
+    rotations = rotation_matrices(random_axes * rotation_angles.reshape(-1, 1))
+    rotated_accel = np.einsum("tij,tj->ti", rotations, samples[:, :3])
 
-    return imu_noise_segment
+    return np.hstack([rotated_accel, samples[:, 3:]]), offsets
 
 
 def incident_movement(
@@ -348,31 +335,6 @@ def environmental_movement(
     raise NotImplementedError
 
 
-def generate_sudden_change(noise, noise_length):
-    """
-    Generate a sudden change or quick peak noise segment.
-
-    Parameters:
-        noise (array): Base noise array to reference recent sensor values.
-        noise_length (int): Length of the generated noise segment.
-        intensity (float): Multiplier to control the magnitude of the peak.
-        peak_duration (int): Duration of the peak within the noise_shape.
-
-    Returns:
-        array: Generated sudden change noise segment.
-    """
-    imu_noise_segment = generate_patterned_imu_noise(
-        noise,
-        reference_length=5,
-        noise_type="sudden_change",
-        max_length=noise_length,
-        range_percentage=0.5,  # rest position
-        peak_probability=0.5,
-        peak_intensity=0.3,
-    )
-    return imu_noise_segment
-
-
 from scipy.spatial.transform import Slerp
 
 
@@ -410,25 +372,62 @@ def interpolate_transition(data_start, data_end, num_steps):
     return transition_data
 
 
-def generate_nonexercise(max_length=50, interpolate_steps=10):
+NONEXERCISE_SOURCE = "./datasets/OpportunityUCIDataset/loco_2_mask.npy"
+
+# (inputs, indices) of the non-exercise source, loaded once per process
+_nonexercise_source = None
+
+
+def load_nonexercise_source(pickle_filename=NONEXERCISE_SOURCE):
+    """
+    Returns the normalized Opportunity inputs and the indices of the non-exercise labels.
+
+    The first call converts the pickled dataset into plain .npy files next to it, which are
+    memory-mapped, so every process (DataLoader and ingestion workers included) shares the
+    same pages instead of loading and normalizing its own copy on every call.
+    """
+    global _nonexercise_source
+    if _nonexercise_source is not None:
+        return _nonexercise_source
+
+    inputs_path = pickle_filename.replace(".npy", "_inputs.npy")
+    indices_path = pickle_filename.replace(".npy", "_indices.npy")
+    if not all(
+        os.path.exists(path)
+        and os.path.getmtime(path) >= os.path.getmtime(pickle_filename)
+        for path in [inputs_path, indices_path]
+    ):
+        data = np.load(pickle_filename, allow_pickle=True).item()
+        inp = data["inputs"] / 9.98  # Normalize data
+        labels = data["labels"]
+        # Filter data indices for the target labels (0, 1, 2, 3)
+        indices = np.where(labels < 4)[0]
+        for path, array in [(inputs_path, inp), (indices_path, indices)]:
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, path)
+
+    _nonexercise_source = (
+        np.load(inputs_path, mmap_mode="r"),
+        np.load(indices_path),
+    )
+    return _nonexercise_source
+
+
+def generate_nonexercise(max_length=50, interpolate_steps=10, rng=np.random):
     """
     Generate a random non-exercise segment with smooth transitions.
 
     Parameters:
         max_length (int): Maximum length of the non-exercise segment.
         interpolate_steps (int): Number of steps for smooth interpolation.
+        rng (RandomState): Generator the segment is drawn from, np.random by default.
 
     Returns:
         array: Generated non-exercise segment with smooth transitions, shape (variable, 6)
     """
-    # Load the dataset
-    pickle_filename = "./datasets/OpportunityUCIDataset/loco_2_mask.npy"
-    data = np.load(pickle_filename, allow_pickle=True).item()
-    inp = data["inputs"] / 9.98  # Normalize data
-    labels = data["labels"]
-
-    # Filter data indices for the target labels (0, 1, 2, 3)
-    indices = np.where(labels < 4)[0]
+    inp, indices = load_nonexercise_source()
 
     # Initialize storage for the final segment
     generated_segment = []
@@ -436,14 +435,14 @@ def generate_nonexercise(max_length=50, interpolate_steps=10):
 
     while current_length < max_length:
         # Randomly select a starting point in the filtered data
-        start = np.random.choice(indices)
-        end = start + np.random.randint(max_length // 5, max_length // 2)
+        start = rng.choice(indices)
+        end = start + rng.randint(max_length // 5, max_length // 2)
 
         # Clip end index to avoid overflow
         end = min(end, len(inp))
 
         # Extract the selected segment and check the length
-        segment = inp[start:end, :]
+        segment = np.array(inp[start:end, :])
         if len(segment) < 2:  # Skip if too short for interpolation
             continue
 
@@ -454,8 +453,8 @@ def generate_nonexercise(max_length=50, interpolate_steps=10):
         # Add interpolated transition if still within max length
         if current_length < max_length:
             # Create a transition between the end of this segment and the start of the next
-            next_start = np.random.choice(indices)
-            next_segment = inp[next_start : next_start + 1, :]
+            next_start = rng.choice(indices)
+            next_segment = np.array(inp[next_start : next_start + 1, :])
             if len(next_segment) > 0:
                 transition_data = interpolate_transition(
                     segment[-1], next_segment[0], interpolate_steps
@@ -489,3 +488,30 @@ def model_exception_handler(model_path):
     # Register the signal handler
     signal.signal(signal.SIGINT, signal_handler)
     return
+
+
+def get_rng_state():
+    # states of the python, numpy and torch (CPU and CUDA) generators, for checkpoints
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    # the states are CPU byte tensors, whatever the map_location of the checkpoint
+    torch.set_rng_state(state["torch"].cpu())
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def save_checkpoint(checkpoint, path):
+    # written to a temporary file first, so a preemption while saving keeps the last one
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)